@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+Throughput of bootstrap() over a corpus of Fritz!Box assets, checked
+against the former implementation which applied one re.sub per rule.
+
+Every asset of the corpus is bootstrapped by both implementations. The run
+fails if any result differs by a single byte.
+
+usage: bench_bootstrap.py [corpusDir] [rounds]
+       bench_bootstrap.py -record <fritzboxHost> <storeDirectory> <corpusDir>
+
+Without corpusDir, a synthetic corpus exercising all rewrite rules is used.
+The -record mode fetches the raw (not bootstrapped) upstream content of
+every sanitized asset in a fritzmesh asset store, so a corpus of real
+assets can be built from the cache of a running installation.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fritzmesh_addon_dev'))
+import fritzmesh
+
+INGRESSREP = fritzmesh.INGRESSREP
+
+
+def legacyFix(contentString, pattern, repl):
+  return re.sub(pattern, repl, contentString.group(0), flags=re.S)
+
+def legacySanitize(images, INGRESSREP):
+  return re.sub(r':"/', r':"' + INGRESSREP, images.group(0), flags=re.S)
+
+def legacyBootstrap(path, contentString):
+  contentString = re.sub(r'<script src="/', r'<script src="' + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r'from\s*"/', r' from "' + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r' href="/', r' href="' + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r':\s*url\(/', r':url(' + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r':\s*url\(\'/', r": url('" + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r'@import\s*"/', r'@import "' + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r';const script="/', r';const script="' + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r'"/?data.lua"', r'"' + INGRESSREP + r'data.lua"', contentString, flags=re.S)
+  contentString = re.sub(r'src:"/', r'src:"' + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r'jsl\.loadCss\("', r'jsl.loadCss("' + INGRESSREP, contentString, flags=re.S)
+  contentString = re.sub(r'"/start"', r'"' + INGRESSREP + r'start"', contentString, flags=re.S)
+  contentString = re.sub(r'logoutWarning:true', r'logoutWarning:false', contentString, flags=re.S)
+  contentString = re.sub(r'(const images\s*=\s*\{(.*?)\})', lambda contentString: legacySanitize(contentString, INGRESSREP), contentString, flags=re.S)
+
+  if path in fritzmesh.bootStrapConfigs:
+    for bsConfig in fritzmesh.bootStrapConfigs[path]:
+      contentString = re.sub(bsConfig[0], lambda contentString: legacyFix(contentString, bsConfig[1], bsConfig[2]), contentString, flags=re.S)
+
+  if path in fritzmesh.bootStrapInjections:
+    contentString = fritzmesh.bootStrapInjections[path] + contentString
+
+  return contentString
+
+
+def syntheticCorpus():
+  # modelled after the assets of the mesh page: a main page, many js modules
+  # and some stylesheets, each only containing some kinds of links
+  jsFiller   = 'function f(x) { return {a: x * 2, b: "text"}; } // Fritz!Box äöü\n'
+  cssFiller  = '.class > div { color: #123456; margin: 0 1rem; }\n'
+  corpus = dict()
+  corpus['/?sid=0123456789abcdef&lp=meshNet'] = (
+      '<html><head>' + '<script src="/js/a%d.js"></script><link href="/css/b%d.css">' * 40
+      + '</head><body><script>const images = {logo:"/img/logo.png", bg:"/img/bg.png", src:"/img/x.png"};'
+      + 'const config = {logoutWarning:true, start:"/start"};</script></body></html>')
+  for n in range(30):
+    corpus['/js/module%d.js' % n] = (
+        'import {a} from "/js/lib%d.js";\nimport {b} from"/js/util.js";\n' % n + jsFiller * 300
+        + 'ajax("/data.lua", {page: "homeNet"});\nconst img = {src:"/img/%d.png"};\n' % n + jsFiller * 300)
+  for n in range(10):
+    corpus['/css/style%d.css' % n] = (
+        '@import "/css/base.css";\n' + cssFiller * 200
+        + '.icon { background: url(/img/icon%d.svg) } .x { background: url(\'/img/x.png\') }\n' % n + cssFiller * 200)
+  corpus['/js/jsl.js'] = jsFiller * 400 + 'jsl.loadCss("/css/dialog.css");jsl.loadCss("/data.lua");;const script="/js/x.js";\n'
+  corpus['/components/PageTabs/style.css'] = '.page-tabs--visible { display: flex; color: red }\n' + cssFiller * 200
+  corpus['/css/box.css'] = (':root { --page-tabs-height-min-l: 3rem; --page-tabs-height-max-m: 2rem; --height-header-top: 4rem;'
+                            ' --height-header-top-small: 2rem; --width-nav-left: 10rem; --height-breadcrumbs: 1rem }\n'
+                            '#blueBarBox { z-index: 3 } .a { x: y } .menuArea { padding: 1rem }\n' + cssFiller * 200)
+  corpus['/net/mesh_overview.css'] = '@media only screen and (max-width: 800px) { a { b: c } }\n' + cssFiller * 200
+  corpus['/net/mesh_overview.js'] = ('const blocks = [buildGraph(data), buildIntro(data), buildMeshablesInfo(data), '
+                                     'buildTable(data), buildUpdateButton(data)];\n' + jsFiller * 200)
+  return corpus
+
+
+def loadCorpus(corpusDir):
+  with open(os.path.join(corpusDir, 'manifest.json'), 'r') as f:
+    manifest = json.load(f)
+  corpus = dict()
+  for fileName, (path, encoding) in manifest.items():
+    with open(os.path.join(corpusDir, fileName), 'rb') as f:
+      corpus[path] = str(f.read(), encoding=encoding)
+  return corpus
+
+
+def record(fritzboxHost, storeDirectory, corpusDir):
+  import requests
+  with open(os.path.join(storeDirectory, 'index.json'), 'r') as f:
+    index = json.load(f)
+
+  os.makedirs(corpusDir, exist_ok = True)
+  manifest = dict()
+  paths = set()
+  for item in index['entries']:
+    path = item['path']
+    if item['sanitized'] and path not in paths:
+      paths.add(path)
+      response = requests.get('http://' + fritzboxHost + path)
+      fileName = '%04d.asset' % len(manifest)
+      with open(os.path.join(corpusDir, fileName), 'wb') as f:
+        f.write(response.content)
+      manifest[fileName] = (path, response.encoding)
+
+  with open(os.path.join(corpusDir, 'manifest.json'), 'w') as f:
+    json.dump(manifest, f, indent = 1)
+  print('recorded %d assets' % len(manifest))
+
+
+def measure(function, corpus, rounds):
+  start = time.perf_counter()
+  for _ in range(rounds):
+    for path, contentString in corpus.items():
+      function(path, contentString)
+  return (time.perf_counter() - start) / rounds
+
+
+def run(corpus, rounds):
+  size = sum(len(contentString) for contentString in corpus.values())
+  print('corpus: %d assets, %d KiB' % (len(corpus), size // 1024))
+
+  mismatches = [path for path, contentString in corpus.items()
+                if fritzmesh.bootstrap(path, contentString) != legacyBootstrap(path, contentString)]
+  for path in mismatches:
+    print('MISMATCH:', path)
+
+  legacy   = measure(legacyBootstrap, corpus, rounds)
+  compiled = measure(fritzmesh.bootstrap, corpus, rounds)
+  print('re.sub per rule:   %8.2f ms per corpus' % (legacy * 1000))
+  print('compiled rules:    %8.2f ms per corpus' % (compiled * 1000))
+  print('speedup:           %8.2fx' % (legacy / compiled))
+  return not mismatches
+
+
+if __name__ == '__main__':
+  if sys.argv[1:2] == ['-record']:
+    record(*sys.argv[2:5])
+  else:
+    corpus = loadCorpus(sys.argv[1]) if len(sys.argv) > 1 else syntheticCorpus()
+    sys.exit(0 if run(corpus, int(sys.argv[2]) if len(sys.argv) > 2 else 20) else 1)
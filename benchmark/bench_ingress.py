@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Requests per second of do_GET for a large sanitized asset.
+
+Compares the former decode/replace/encode rendering of the ingress path
+and a split-template join per request with do_GET, which serves the
+rendered (and precompressed) variant from the asset store. The handlers
+are called in-process, so the numbers exclude socket overhead.
+
+usage: bench_ingress.py [assetKiB] [seconds]
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from functools import partial
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from multidict import CIMultiDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fritzmesh_addon_dev'))
+import fritzmesh
+
+assetPath = '/js/bundle.js'
+
+
+def createAsset(size):
+  chunk = 'import {x} from "' + fritzmesh.INGRESSREP + 'js/lib.js";\n' + 'const a = "äöü";\n' * 60
+  return (chunk * (size // len(chunk) + 1)).encode('utf-8')
+
+
+def legacyHandler(content):
+  async def handler(request):
+    responseString = str(content, 'utf-8')
+    responseString = responseString.replace(fritzmesh.INGRESSREP, request.headers.get('x-ingress-path') + '/')
+    return web.Response(body = bytes(responseString, 'utf-8'), content_type = 'application/javascript')
+  return handler
+
+
+def templateHandler(content):
+  segments = content.split(fritzmesh.INGRESSREP_BYTES)
+  async def handler(request):
+    body = (request.headers.get('x-ingress-path') + '/').encode('utf-8').join(segments)
+    return web.Response(body = body, content_type = 'application/javascript')
+  return handler
+
+
+async def measure(handler, seconds):
+  request = make_mocked_request('GET', assetPath, headers = {'x-ingress-path': '/api/hassio_ingress/abcdef'})
+  count = 0
+  start = time.perf_counter()
+  while time.perf_counter() - start < seconds:
+    for _ in range(100):
+      await handler(request)
+    count += 100
+  return count / (time.perf_counter() - start)
+
+
+async def run(assetKiB, seconds):
+  fritzmesh.storeDirectory = tempfile.mkdtemp(prefix = 'fritzmesh')
+  fritzmesh.openAssetStore()
+
+  box = fritzmesh.FritzBox('', 'fritz.box', '', '')
+  fritzmesh.fritzBoxes.append(box)
+
+  content = createAsset(assetKiB * 1024)
+  headers = CIMultiDict({'Content-type': 'application/javascript;charset=utf-8'})
+  fritzmesh.cachedData[(box.generation, assetPath)] = fritzmesh.createCacheEntry(
+      assetPath, headers, content, True, time.time(), None)
+  print('asset size: %d KiB, %d ingress markers' % (len(content) // 1024, content.count(fritzmesh.INGRESSREP_BYTES)))
+
+  print('decode/replace/encode: %8.0f req/s' % await measure(legacyHandler(content), seconds))
+  print('template join:         %8.0f req/s' % await measure(templateHandler(content), seconds))
+  print('rendered variant:      %8.0f req/s' % await measure(partial(fritzmesh.do_GET, box), seconds))
+
+  shutil.rmtree(fritzmesh.storeDirectory)
+
+
+if __name__ == '__main__':
+  asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 512,
+                  float(sys.argv[2]) if len(sys.argv) > 2 else 2.0))
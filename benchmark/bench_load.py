@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+Throughput and cost of the daemon under concurrent client load.
+
+Starts the Fritz!Box simulator (stub_fritzbox.py) with a synthetic mesh and
+the fritzmesh daemon, each in a process of its own, and drives one scenario
+with a number of concurrent clients:
+
+  assets   GET of the cached entry page and assets (do_GET)
+  luadata  POST of /data.lua (handleLuaDataRequest)
+  poller   push channels on /data.sse while the mesh changes (the poller)
+
+Reports the requests (or, for the poller, the polls and delivered events)
+per second, the latency percentiles, the CPU time of the daemon per request
+and its resident memory. The CPU time and memory cover the workers as well.
+
+usage: bench_load.py [--scenario assets|luadata|poller] [--clients 50]
+                     [--seconds 10] [--nodes 20] [--links 30] [--churn 2]
+                     [--workers 1] [--poll-interval 0.1]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fritzmesh_addon_dev'))
+import fritzmesh
+import stub_fritzbox
+
+clockTicks = os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def freePort():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def processTree(pid):
+  # the daemon and its workers
+  pids = [pid]
+  for entry in filter(str.isdigit, os.listdir('/proc')):
+    try:
+      with open('/proc/%s/stat' % entry) as f:
+        if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+          pids.append(int(entry))
+    except OSError:
+      pass
+  return pids
+
+
+def cpuSeconds(pids):
+  seconds = 0.0
+  for pid in pids:
+    with open('/proc/%d/stat' % pid) as f:
+      fields = f.read().rsplit(')', 1)[1].split()
+    seconds += (int(fields[11]) + int(fields[12])) / clockTicks
+  return seconds
+
+
+def memoryKiB(pids, name):
+  kib = 0
+  for pid in pids:
+    with open('/proc/%d/status' % pid) as f:
+      kib += sum(int(line.split()[1]) for line in f if line.startswith(name + ':'))
+  return kib
+
+
+def runDaemon(stubPort, port, workers, pollInterval, directory):
+  # the daemon of main(), configured for the simulator
+  fritzmesh.storeDirectory     = directory
+  fritzmesh.workerCount        = workers
+  fritzmesh.mainPort           = port
+  fritzmesh.activePollInterval = pollInterval
+  fritzmesh.openAssetStore()
+  fritzmesh.fritzBoxes.append(fritzmesh.FritzBox('', '127.0.0.1:%d' % stubPort, '', ''))
+  try:
+    web.run_app(fritzmesh.createApp(), host = '127.0.0.1', port = port, reuse_port = workers > 1,
+                path = fritzmesh.ownerSocketPath() if workers > 1 else None, print = None)
+  except KeyboardInterrupt:
+    pass
+
+
+async def waitForDaemon(session, url, workers):
+  # until the daemon polled the box, the workers start with the daemon
+  while True:
+    try:
+      async with session.get(url + '/ready') as response:
+        await response.read()
+        if response.status == 200:
+          break
+    except aiohttp.ClientError:
+      pass
+    await asyncio.sleep(0.1)
+  if workers > 1:
+    await asyncio.sleep(2.0)
+
+
+async def polledCount(session, url):
+  async with session.get(url + '/metrics') as response:
+    for line in (await response.text()).splitlines():
+      if line.startswith('fritzmesh_polls_total'):
+        return int(float(line.split()[-1]))
+  return 0
+
+
+async def requestLoop(session, url, paths, post, latencies, errors, done):
+  n = 0
+  while not done.is_set():
+    path = paths[n % len(paths)]
+    n += 1
+    start = time.perf_counter()
+    try:
+      async with (session.post if post else session.get)(url + path) as response:
+        await response.read()
+        if response.status != 200:
+          errors.append(response.status)
+    except aiohttp.ClientError as e:
+      errors.append(repr(e))
+    latencies.append(time.perf_counter() - start)
+
+
+async def pushChannel(session, url, events, errors, done):
+  try:
+    async with session.get(url + '/data.sse') as response:
+      while not done.is_set():
+        try:
+          line = await asyncio.wait_for(response.content.readline(), 0.5)
+        except asyncio.TimeoutError:
+          continue
+        if not line:
+          break
+        if line.startswith(b'id: '):
+          events.append(time.perf_counter())
+  except aiohttp.ClientError as e:
+    errors.append(repr(e))
+
+
+async def drive(options, url, daemonPid):
+  latencies = []
+  events    = []
+  errors    = []
+  done      = asyncio.Event()
+  async with aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = 0),
+                                   timeout = aiohttp.ClientTimeout(total = None)) as session:
+    await waitForDaemon(session, url, options.workers)
+    paths = ['/'] + stub_fritzbox.assetPaths()
+    for path in paths:
+      async with session.get(url + path) as response:
+        await response.read()
+
+    pids    = processTree(daemonPid)
+    polls   = await polledCount(session, url)
+    cpu     = cpuSeconds(pids)
+    start   = time.perf_counter()
+    if options.scenario == 'poller':
+      clients = [pushChannel(session, url, events, errors, done) for _ in range(options.clients)]
+    else:
+      post    = options.scenario == 'luadata'
+      clients = [requestLoop(session, url, ['/data.lua'] if post else paths, post, latencies, errors, done)
+                 for _ in range(options.clients)]
+    clients = [asyncio.ensure_future(client) for client in clients]
+    await asyncio.sleep(options.seconds)
+    cpu     = cpuSeconds(pids) - cpu
+    elapsed = time.perf_counter() - start
+    polls   = await polledCount(session, url) - polls
+    done.set()
+    await asyncio.gather(*clients)
+  return latencies, events, errors, polls, cpu, elapsed, pids
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Load test of the fritzmesh daemon against the Fritz!Box simulator')
+  parser.add_argument('--scenario',      choices = ('assets', 'luadata', 'poller'), default = 'assets')
+  parser.add_argument('--clients',       type = int,   default = 50)
+  parser.add_argument('--seconds',       type = float, default = 10.0)
+  parser.add_argument('--nodes',         type = int,   default = 20)
+  parser.add_argument('--links',         type = int,   default = 30)
+  parser.add_argument('--churn',         type = float, default = 2.0, help = 'link rate changes per second')
+  parser.add_argument('--workers',       type = int,   default = 1)
+  parser.add_argument('--poll-interval', type = float, default = 0.1, help = 'active poll interval of the daemon')
+  options = parser.parse_args()
+
+  stubPort = freePort()
+  port     = freePort()
+  stub = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'stub_fritzbox.py'),
+                           '--port', str(stubPort), '--nodes', str(options.nodes), '--links', str(options.links),
+                           '--churn', str(options.churn), '--asset-delay', '0'],
+                          stdout = subprocess.DEVNULL)
+  directory = tempfile.mkdtemp(prefix = 'fritzmesh')
+  daemon = multiprocessing.get_context('spawn').Process(
+      target = runDaemon, args = (stubPort, port, options.workers, options.poll_interval, directory))
+  daemon.start()
+  try:
+    latencies, events, errors, polls, cpu, elapsed, pids = asyncio.run(
+        drive(options, 'http://127.0.0.1:%d' % port, daemon.pid))
+    rss, peak = memoryKiB(pids, 'VmRSS'), memoryKiB(pids, 'VmHWM')
+  finally:
+    daemon.terminate()
+    daemon.join()
+    stub.terminate()
+    stub.wait()
+    shutil.rmtree(directory, ignore_errors = True)
+
+  print('scenario:           %s' % options.scenario)
+  print('clients:            %d' % options.clients)
+  print('workers:            %d' % options.workers)
+  print('mesh:               %d nodes, %d links, %.1f changes/s' % (options.nodes, options.links, options.churn))
+  print('polls:              %d (%.1f/s)' % (polls, polls / elapsed))
+  if options.scenario == 'poller':
+    print('events:             %d (%.0f/s)' % (len(events), len(events) / elapsed))
+    print('CPU per poll:       %.2fms' % (cpu / max(polls, 1) * 1000))
+  else:
+    print('requests:           %d (%.0f req/s)' % (len(latencies), len(latencies) / elapsed))
+    print('latency p50:        %.2fms' % (percentile(latencies, 50) * 1000))
+    print('latency p90:        %.2fms' % (percentile(latencies, 90) * 1000))
+    print('latency p99:        %.2fms' % (percentile(latencies, 99) * 1000))
+    print('CPU per request:    %.3fms' % (cpu / max(len(latencies), 1) * 1000))
+  print('CPU utilization:    %.0f%%' % (cpu / elapsed * 100))
+  print('RSS:                %.1fMiB (peak %.1fMiB)' % (rss / 1024, peak / 1024))
+  print('errors:             %d' % len(errors))
+  return 1 if errors else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
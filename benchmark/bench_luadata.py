@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+/data.lua under a crowd of concurrent pollers while the mesh keeps changing.
+
+Starts the stub Fritz!Box and the fritzmesh web application in-process,
+with a mesh that changes on every upstream poll and the shortest possible
+poll interval. A number of clients poll /data.lua as fast as they can.
+Reports requests per second and latency percentiles, and verifies that
+every answer is consistent, i.e. its body matches its ETag.
+
+usage: bench_luadata.py [pollers] [seconds]
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fritzmesh_addon_dev'))
+import fritzmesh
+import stub_fritzbox
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def pollLuaData(session, url, latencies, done):
+  inconsistent = 0
+  while not done.is_set():
+    start = time.perf_counter()
+    async with session.post(url + '/data.lua') as response:
+      body = await response.read()
+      etag = response.headers.get('ETag')
+    latencies.append(time.perf_counter() - start)
+    # the body is decompressed, ignore the content coding of the tag
+    if not fritzmesh.matchesEtag(etag, fritzmesh.contentTag(body)):
+      inconsistent += 1
+  return inconsistent
+
+
+async def changeMesh(done):
+  # a new mesh on every upstream poll
+  while not done.is_set():
+    stub_fritzbox.homeNet['data']['nodes'] = [{'uid': 'node%d' % n, 'rate': time.perf_counter()} for n in range(50)]
+    await asyncio.sleep(0.001)
+
+
+async def run(pollers, seconds):
+  fritzmesh.activePollInterval = 0.005
+  fritzmesh.storeDirectory = tempfile.mkdtemp(prefix = 'fritzmesh')
+  fritzmesh.openAssetStore()
+
+  stubRunner, stubPort = await stub_fritzbox.start()
+  box = fritzmesh.FritzBox('', '127.0.0.1:%d' % stubPort, '', '')
+  fritzmesh.fritzBoxes.append(box)
+
+  runner = web.AppRunner(fritzmesh.createApp())
+  await runner.setup()
+  site = web.TCPSite(runner, '127.0.0.1', 0)
+  await site.start()
+  url = 'http://127.0.0.1:%d' % runner.addresses[0][1]
+  while not all(box.startupState == 'ready' for box in fritzmesh.fritzBoxes):
+    await asyncio.sleep(0.01)
+
+  latencies = []
+  done      = asyncio.Event()
+  firstVersion = box.luaSnapshot.version
+  async with aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = 0)) as session:
+    changer = asyncio.ensure_future(changeMesh(done))
+    clients = [asyncio.ensure_future(pollLuaData(session, url, latencies, done)) for _ in range(pollers)]
+    await asyncio.sleep(seconds)
+    done.set()
+    inconsistent = sum(await asyncio.gather(*clients))
+    await changer
+  snapshots = box.luaSnapshot.version - firstVersion
+
+  await runner.cleanup()
+  await stubRunner.cleanup()
+  shutil.rmtree(fritzmesh.storeDirectory)
+
+  print('pollers:            %d' % pollers)
+  print('snapshots:          %d' % snapshots)
+  print('/data.lua requests: %d (%.0f req/s)' % (len(latencies), len(latencies) / seconds))
+  print('/data.lua p50:      %.2fms' % (percentile(latencies, 50) * 1000))
+  print('/data.lua p99:      %.2fms' % (percentile(latencies, 99) * 1000))
+  print('/data.lua max:      %.2fms' % (max(latencies) * 1000))
+  print('inconsistent:       %d' % inconsistent)
+  return inconsistent
+
+
+if __name__ == '__main__':
+  inconsistent = asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+                                 float(sys.argv[2]) if len(sys.argv) > 2 else 5.0))
+  sys.exit(1 if inconsistent else 0)
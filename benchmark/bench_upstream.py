@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Latency of /data.lua while a crowd of browsers opens a cold dashboard.
+
+Starts the stub Fritz!Box and the fritzmesh web application in-process,
+lets a number of clients request all (uncached) static assets at once and
+polls /data.lua in parallel. Reports the /data.lua latency percentiles and
+the number of upstream asset fetches.
+
+usage: bench_upstream.py [clients] [assetDelay]
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fritzmesh_addon_dev'))
+import fritzmesh
+import stub_fritzbox
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def pollLuaData(session, url, latencies, done):
+  while not done.is_set():
+    start = time.perf_counter()
+    async with session.post(url + '/data.lua') as response:
+      await response.read()
+    latencies.append(time.perf_counter() - start)
+    await asyncio.sleep(0.01)
+
+
+async def openDashboard(session, url):
+  for path in stub_fritzbox.assetPaths():
+    async with session.get(url + path) as response:
+      await response.read()
+
+
+async def run(clients):
+  upstreamFetches = 0
+  fetchResponse   = fritzmesh.fetchResponse
+
+  async def countingFetch(box, key, *client):
+    nonlocal upstreamFetches
+    upstreamFetches += 1
+    return await fetchResponse(box, key, *client)
+  fritzmesh.fetchResponse = countingFetch
+
+  # the dashboard is opened with a cold cache, only the main page is fetched
+  # on startup
+  fritzmesh.prefetchConcurrency = 0
+  fritzmesh.storeDirectory = tempfile.mkdtemp(prefix = 'fritzmesh')
+  fritzmesh.openAssetStore()
+
+  stubRunner, stubPort = await stub_fritzbox.start()
+  fritzmesh.fritzBoxes.append(fritzmesh.FritzBox('', '127.0.0.1:%d' % stubPort, '', ''))
+
+  runner = web.AppRunner(fritzmesh.createApp())
+  await runner.setup()
+  site = web.TCPSite(runner, '127.0.0.1', 0)
+  await site.start()
+  url = 'http://127.0.0.1:%d' % runner.addresses[0][1]
+  while not all(box.startupState == 'ready' for box in fritzmesh.fritzBoxes):
+    await asyncio.sleep(0.01)
+
+  latencies = []
+  done      = asyncio.Event()
+  async with aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = 0)) as session:
+    poller = asyncio.ensure_future(pollLuaData(session, url, latencies, done))
+    start  = time.perf_counter()
+    await asyncio.gather(*[openDashboard(session, url) for _ in range(clients)])
+    elapsed = time.perf_counter() - start
+    done.set()
+    await poller
+
+  await runner.cleanup()
+  await stubRunner.cleanup()
+  shutil.rmtree(fritzmesh.storeDirectory)
+
+  print('clients:            %d' % clients)
+  print('assets:             %d (upstream delay %.2fs)' % (stub_fritzbox.assetCount, stub_fritzbox.assetDelay))
+  print('upstream fetches:   %d' % (upstreamFetches - 1))
+  print('dashboard load:     %.2fs' % elapsed)
+  print('/data.lua requests: %d' % len(latencies))
+  print('/data.lua p50:      %.2fms' % (percentile(latencies, 50) * 1000))
+  print('/data.lua p99:      %.2fms' % (percentile(latencies, 99) * 1000))
+  print('/data.lua max:      %.2fms' % (max(latencies) * 1000))
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 2:
+    stub_fritzbox.assetDelay = float(sys.argv[2])
+  asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 30))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for a Fritz!Box web server, used by the benchmarks.
+
+Serves the bootstrap entry page, a set of static assets with a configurable
+response delay and the homeNet answer on /data.lua. The assets carry an
+ETag of the firmware version in /jason_boxinfo.xml and answer conditional
+requests. /login_sid.lua implements the PBKDF2 challenge-response login,
+accepting any user with the password stub_fritzbox.password.
+
+The homeNet mesh is empty, set by the caller, or a synthetic one of
+setMesh(): a tree of nodes plus further links between them. With a churn
+rate, that many link rates per second change.
+
+Run standalone, it serves a synthetic mesh until interrupted:
+usage: stub_fritzbox.py [--port 8080] [--nodes 20] [--links 30] [--churn 2]
+                        [--lua-delay 0] [--asset-delay 0.5] [--password '']
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from aiohttp import web
+
+assetDelay = 0.5
+assetCount = 20
+assetSize  = 64 * 1024
+
+firmwareVersion = '154.07.57'
+
+password   = ''
+challenge  = '2$1000$0123456789abcdef$100$fedcba9876543210'
+logins     = 0
+
+homeNet = {'pid': 'homeNet', 'sid': '0123456789abcdef', 'data': {'nodes': []}}
+
+luaDelay   = 0.0
+meshChurn  = 0.0
+meshLinks  = []
+meshRandom = random.Random(0)
+churned    = time.monotonic()
+
+
+def assetPaths():
+  return ['/js/asset%d.js' % n for n in range(assetCount)]
+
+
+async def handleEntry(request):
+  scripts = ''.join('<script src="%s"></script>' % path for path in assetPaths())
+  return web.Response(
+      text = '<html><head>' + scripts + '</head><body></body></html>',
+      content_type = 'text/html', charset = 'utf-8')
+
+
+async def handleAsset(request):
+  await asyncio.sleep(assetDelay)
+  etag = '"' + firmwareVersion + '-' + request.match_info['name'] + '"'
+  if request.headers.get('If-None-Match') == etag:
+    return web.Response(status = 304, headers = {'ETag': etag})
+
+  body = 'const script="/' + request.match_info['name'] + '";/*' + firmwareVersion + '*/\n'
+  body += 'x' * (assetSize - len(body))
+  return web.Response(
+      text = body,
+      headers = {'Content-Type': 'application/javascript;charset=utf-8', 'ETag': etag})
+
+
+def randomRate():
+  return meshRandom.choice([0, 1000, 26000, 144000, 286000, 573000, 866000, 1200000, 2400000])
+
+
+def setMesh(nodeCount, linkCount):
+  # a master, connected to the other nodes by a random tree, plus random
+  # further links. Each link is listed by the interfaces of both ends.
+  global meshLinks
+  meshLinks = []
+  nodes = [{'uid': 'n-%d' % n,
+            'device_name': 'fritz.box' if n == 0 else 'device-%d' % n,
+            'device_mac_address': '02:00:00:00:%02X:%02X' % (n // 256, n % 256),
+            'device_model': 'FRITZ!Box 7590' if n == 0 else 'FRITZ!Repeater 2400',
+            'mesh_role': 'master' if n == 0 else 'slave',
+            'is_meshed': True,
+            'node_interfaces': [{'uid': 'ni-%d' % n, 'name': 'WLAN', 'type': 'WLAN', 'node_links': []}]}
+           for n in range(nodeCount)]
+  pairs = [(meshRandom.randrange(n), n) for n in range(1, nodeCount)]
+  while nodeCount > 1 and len(pairs) < max(linkCount, nodeCount - 1):
+    pairs.append(tuple(meshRandom.sample(range(nodeCount), 2)))
+  for n, (node1, node2) in enumerate(pairs):
+    link = {'uid': 'nl-%d' % n, 'type': 'WLAN', 'state': 'CONNECTED',
+            'node_1_uid': nodes[node1]['uid'], 'node_2_uid': nodes[node2]['uid'],
+            'node_interface_1_uid': 'ni-%d' % node1, 'node_interface_2_uid': 'ni-%d' % node2,
+            'max_data_rate_rx': 2400000, 'max_data_rate_tx': 2400000,
+            'cur_data_rate_rx': randomRate(), 'cur_data_rate_tx': randomRate()}
+    nodes[node1]['node_interfaces'][0]['node_links'].append(link)
+    nodes[node2]['node_interfaces'][0]['node_links'].append(link)
+    meshLinks.append(link)
+  homeNet['data']['nodes'] = nodes
+
+
+def churnMesh():
+  # change the link rates that were due since the last request
+  global churned
+  changes = int((time.monotonic() - churned) * meshChurn)
+  if changes == 0 or not meshLinks:
+    return
+  churned += changes / meshChurn
+  for link in meshRandom.sample(meshLinks, min(changes, len(meshLinks))):
+    link['cur_data_rate_rx'] = randomRate()
+    link['cur_data_rate_tx'] = randomRate()
+    link['state'] = 'CONNECTED' if link['cur_data_rate_rx'] else 'DISCONNECTED'
+
+
+def loginAnswer(sid, challenge = ''):
+  return web.Response(
+      text = '<SessionInfo><SID>' + sid + '</SID><Challenge>' + challenge + '</Challenge></SessionInfo>',
+      content_type = 'text/xml')
+
+
+async def handleLogin(request):
+  global logins
+  sid = homeNet['sid']
+  if request.method == 'GET':
+    return loginAnswer(sid if request.query.get('sid') == sid else '0000000000000000', challenge)
+
+  form = await request.post()
+  _, iterations1, salt1, iterations2, salt2 = challenge.split('$')
+  staticHash  = hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt1), int(iterations1))
+  dynamicHash = hashlib.pbkdf2_hmac('sha256', staticHash, bytes.fromhex(salt2), int(iterations2))
+  if form.get('response') != salt2 + '$' + dynamicHash.hex():
+    return loginAnswer('0000000000000000', challenge)
+  logins += 1
+  return loginAnswer(sid)
+
+
+async def handleBoxInfo(request):
+  return web.Response(
+      text = '<j:BoxInfo xmlns:j="http://jason.avm.de/updatecheck/"><j:Name>FRITZ!Box Stub</j:Name>'
+             '<j:Version>' + firmwareVersion + '</j:Version></j:BoxInfo>',
+      content_type = 'text/xml')
+
+
+async def handleLuaData(request):
+  if luaDelay:
+    await asyncio.sleep(luaDelay)
+  if meshChurn:
+    churnMesh()
+  return web.Response(text = json.dumps(homeNet), content_type = 'application/json')
+
+
+def createApp():
+  app = web.Application()
+  app.add_routes([web.get('/', handleEntry),
+                  web.get('/js/{name}', handleAsset),
+                  web.get('/jason_boxinfo.xml', handleBoxInfo),
+                  web.get('/login_sid.lua', handleLogin),
+                  web.post('/login_sid.lua', handleLogin),
+                  web.post('/data.lua', handleLuaData)])
+  return app
+
+
+async def start(port = 0):
+  runner = web.AppRunner(createApp())
+  await runner.setup()
+  site = web.TCPSite(runner, '127.0.0.1', port)
+  await site.start()
+  return runner, runner.addresses[0][1]
+
+
+def main():
+  global luaDelay, meshChurn, assetDelay, password
+  parser = argparse.ArgumentParser(description = 'Local stand-in for a Fritz!Box web server')
+  parser.add_argument('--port',        type = int,   default = 8080)
+  parser.add_argument('--nodes',       type = int,   default = 20,  help = 'mesh nodes')
+  parser.add_argument('--links',       type = int,   default = 30,  help = 'mesh links, at least nodes - 1')
+  parser.add_argument('--churn',       type = float, default = 2.0, help = 'link rate changes per second')
+  parser.add_argument('--lua-delay',   type = float, default = 0.0, help = 'response delay of /data.lua, seconds')
+  parser.add_argument('--asset-delay', type = float, default = assetDelay, help = 'response delay of assets, seconds')
+  parser.add_argument('--password',    default = password)
+  options = parser.parse_args()
+
+  luaDelay, meshChurn, assetDelay, password = options.lua_delay, options.churn, options.asset_delay, options.password
+  setMesh(options.nodes, options.links)
+  web.run_app(createApp(), host = '127.0.0.1', port = options.port)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Local webhook receiver, to try the webhooks of the daemon.
+
+Prints every event of the batches posted to it, one JSON line each. With
+a failure rate, that share of the batches is answered 503, so the daemon
+retries them; with a delay, every answer takes that long.
+
+usage: webhook_sink.py [--port 8081] [--fail-rate 0] [--delay 0]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+from aiohttp import web
+
+failRate = 0.0
+delay    = 0.0
+received = []
+
+
+async def handleEvents(request):
+  batch = await request.json()
+  if delay:
+    await asyncio.sleep(delay)
+  if random.random() < failRate:
+    return web.Response(status = 503)
+  for event in batch['events']:
+    received.append(event)
+    print(json.dumps(event), flush = True)
+  return web.Response(status = 204)
+
+
+def createApp():
+  httpd = web.Application()
+  httpd.add_routes([web.post('/{tail:.*}', handleEvents)])
+  return httpd
+
+
+async def start(port = 0):
+  runner = web.AppRunner(createApp())
+  await runner.setup()
+  site = web.TCPSite(runner, '127.0.0.1', port)
+  await site.start()
+  return runner, runner.addresses[0][1]
+
+
+def main():
+  global failRate, delay
+  parser = argparse.ArgumentParser(description = 'Local webhook receiver')
+  parser.add_argument('--port',      type = int,   default = 8081)
+  parser.add_argument('--fail-rate', type = float, default = 0.0, help = 'share of batches answered 503')
+  parser.add_argument('--delay',     type = float, default = 0.0, help = 'answer delay, seconds')
+  options = parser.parse_args()
+
+  failRate, delay = options.fail_rate, options.delay
+  web.run_app(createApp(), host = '127.0.0.1', port = options.port, print = None)
+
+
+if __name__ == '__main__':
+  main()
@@ -25,31 +25,58 @@ SOFTWARE.
 """
 
 import os
-import requests
+import io
+import math
+import zlib
 from xml.etree import ElementTree
 import hashlib
 import threading
 import time
 import json
+import gzip
 from threading import Thread, Lock
-from collections import namedtuple
+from functools import partial
+from itertools import combinations
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import namedtuple, OrderedDict, deque
 import re
 import pickle
-from urllib.parse import urlparse, parse_qsl
+import mmap
+import tempfile
+import shutil
+from urllib.parse import urlparse, parse_qsl, urljoin, urlencode
 import sys
 import configparser
+import multiprocessing
+import asyncio
+import aiohttp
 from aiohttp import web
+from multidict import CIMultiDict
 from datetime import datetime
 
-fritzboxUsername = ''
-fritzboxPassword = ''
-fritzboxHost     = ''
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+  Image = None
 
 invalidSid = "0000000000000000"
 entryUrls  = ("/", "/#homeNet", "/start")
 INGRESSREP = '__INGRESSPATH__'
+INGRESSREP_BYTES = INGRESSREP.encode('utf-8')
 
 sanitizationContentTypes = ("text/html; charset=utf-8", "text/css", "application/javascript;charset=utf-8")
+compressibleContentTypes = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
 
 #see: https://stackoverflow.com/questions/34738611/how-can-i-use-python-to-change-css-attributes-of-an-html-document
 bootStrapConfigs = {
@@ -70,94 +97,1725 @@ bootStrapConfigs = {
 } 
 
 
-luaData          = None
-dataLock         = Lock()
-cachedData       = dict()
-bootstrapSid     = invalidSid
-currentSid       = invalidSid
+# injected into the mesh renderer: answer its homeNet data.lua refresh
+# requests from the push channel (see handleLuaPush) instead of the network.
+# A refresh request is answered as soon as the daemon pushes a change.
+pushShim = r"""
+/* fritzmesh push channel */
+(function() {
+  if (!window.EventSource || window.fritzmeshPush) {
+    return;
+  }
+  const push = window.fritzmeshPush = {data: null, version: null, delivered: null, waiting: []};
+  const source = new EventSource('""" + INGRESSREP + r"""data.sse');
+  source.onmessage = function(event) {
+    push.data    = event.data;
+    push.version = event.lastEventId;
+    const waiting = push.waiting;
+    push.waiting = [];
+    waiting.forEach(function(answer) { answer(); });
+  };
+
+  function isPushed(url, body) {
+    return source.readyState === EventSource.OPEN && push.data !== null &&
+           /data\.lua/.test(String(url)) && /page=homeNet/.test(String(body));
+  }
+
+  function nextSnapshot(deliver) {
+    let done = false;
+    function answer() {
+      if (!done) {
+        done = true;
+        push.delivered = push.version;
+        deliver(push.data);
+      }
+    }
+    if (push.version !== push.delivered) {
+      answer();
+    } else {
+      push.waiting.push(answer);
+      setTimeout(answer, 60000);
+    }
+  }
+
+  const open = XMLHttpRequest.prototype.open;
+  const send = XMLHttpRequest.prototype.send;
+  XMLHttpRequest.prototype.open = function(method, url) {
+    this.fritzmeshUrl = url;
+    return open.apply(this, arguments);
+  };
+  XMLHttpRequest.prototype.send = function(body) {
+    if (!isPushed(this.fritzmeshUrl, body)) {
+      return send.apply(this, arguments);
+    }
+    const xhr = this;
+    nextSnapshot(function(data) {
+      Object.defineProperties(xhr, {
+        readyState:   {value: 4, configurable: true},
+        status:       {value: 200, configurable: true},
+        statusText:   {value: "OK", configurable: true},
+        responseText: {value: data, configurable: true},
+        response:     {value: xhr.responseType === "json" ? JSON.parse(data) : data, configurable: true}
+      });
+      xhr.getResponseHeader = function(name) {
+        return /^content-type$/i.test(name) ? "application/json" : null;
+      };
+      ["readystatechange", "load", "loadend"].forEach(function(type) {
+        xhr.dispatchEvent(new Event(type));
+      });
+    });
+  };
+
+  if (window.fetch) {
+    const fetch = window.fetch;
+    window.fetch = function(resource, init) {
+      if (!isPushed((resource && resource.url) || resource, init && init.body)) {
+        return fetch.apply(this, arguments);
+      }
+      return new Promise(function(resolve) {
+        nextSnapshot(function(data) {
+          resolve(new Response(data, {status: 200, headers: {"Content-Type": "application/json"}}));
+        });
+      });
+    };
+  }
+})();
+"""
+
+bootStrapInjections = {
+  "/net/mesh_overview.js": pushShim
+}
+
+fritzBoxes       = []
+pushClosing      = False
+cachedData       = OrderedDict()
+storedDigests    = dict()
+storeBytes       = 0
+storeDirectory   = None
+mappedObjects    = OrderedDict()
+storeIndexLock   = Lock()
+storeIndexSerial = 0
+storeIndexSaved  = 0
+renderedVariants = OrderedDict()
+ingressPathHits  = OrderedDict()
+storedPaths      = OrderedDict()
+storeOwner       = True
+pendingFetches   = dict()
+pendingVariants  = dict()
+pendingLogins    = dict()
+pendingRenders   = dict()
+webhookTargets   = []
+webhookSession   = None
+spoolDirectory   = None
+historyDirectory = None
+snapshotDirectory = None
+upstreamSession  = None
+assetManifests   = dict()
+manifestFilename = None
+ownerSession     = None
+sharedFiles      = dict()
+failedFetches    = OrderedDict()
+clientBuckets    = OrderedDict()
+
+# upstream client limits: the Fritz!Box web server is slow and easily
+# overloaded, so never run more than a few requests against one in parallel
+upstreamConnections = 4
+upstreamTimeout     = aiohttp.ClientTimeout(total = 30, sock_connect = 5)
+
+# an upstream failure (4xx, 5xx) of a path is answered from memory for
+# negativeCacheTtl seconds, for at most negativeCacheLimit paths
+negativeCacheTtl    = 30.0
+negativeCacheLimit  = 1024
+
+# token buckets of upstream fetches for cache misses, (tokens per second,
+# burst): one per client address, at most clientBucketsLimit of them, and
+# one per box. A miss beyond either is answered 429 Too Many Requests.
+# Requests of trustedProxies (the Home Assistant ingress) count for the
+# client they forward for, the last address of X-Forwarded-For none of
+# them added.
+clientFetchLimit    = (5.0, 50)
+boxFetchLimit       = (10.0, 100)
+clientBucketsLimit  = 1024
+trustedProxies      = ()
+
+# cold start prefetch: at most prefetchConcurrency assets of a box are
+# fetched and processed at once (0: no prefetch), at most prefetchLimit
+# of them per box. Only paths with one of prefetchExtensions are fetched.
+prefetchConcurrency = 4
+prefetchLimit       = 1000
+prefetchExtensions  = ('.js', '.mjs', '.css', '.json', '.png', '.gif', '.jpg', '.jpeg', '.svg', '.ico',
+                       '.woff', '.woff2', '.ttf', '.eot')
+
+# the server starts with the cache and the last mesh snapshot of the
+# previous run, the boxes are logged in to, warmed up and polled in the
+# background. A failed attempt is retried after startupRetryInterval,
+# doubled after each failure up to startupRetryLimit.
+startupRetryInterval  = 1.0
+startupRetryLimit     = 60.0
+
+# the firmware version is checked every few minutes and after each new
+# login, which may follow a reboot into a firmware update
+firmwareCheckInterval = 300.0
+boxInfoNamespace      = '{http://jason.avm.de/updatecheck/}'
+
+# parallel upstream requests of a background revalidation, leaving the
+# other upstream connections to the clients
+revalidationRequests  = 2
+
+# number of (content, ingress path) renderings of sanitized assets kept. The
+# ingress path is chosen by the client: only the renderings for the box
+# prefixes and for the storedIngressPathsLimit ingress paths last asked for
+# ingressPathPromotion times go to the asset store, all others are
+# rendered in memory. Ingress paths must match ingressPathPattern.
+renderedVariantsLimit   = 64
+storedIngressPathsLimit = 2
+ingressPathPromotion    = 8
+ingressPathsLimit       = 64
+ingressPathPattern      = re.compile(r'(/[\w.~%-]+)*/?')
+
+# multi-worker mode: workerCount processes accept on the main port. The
+# first one (the owner) logs in to and polls the boxes and fetches the
+# assets, the others serve the asset store and the snapshots it publishes
+# and forward everything else to the owner. Each worker forwards a
+# /data.lua request to the owner every workerDemandInterval, to keep the
+# mesh polled, and checks every workerIndexInterval for a new store index.
+workerCount           = 1
+mainPort              = None
+workerDemandInterval  = 1.0
+workerIndexInterval   = 1.0
+
+# number of memory mapped asset store objects kept open
+mappedObjectsLimit    = 256
+
+# byte budget of the objects of all cache entries and stored renderings,
+# content codings included: beyond it, the stored renderings and then the
+# least recently used entries are evicted. Assets that are not sanitized are
+# streamed to the client that asks for them first, and only stored if
+# they are at most streamCacheLimit bytes.
+storeByteLimit        = 256 * 1024 * 1024
+streamCacheLimit      = 8 * 1024 * 1024
+
+# compression levels: static assets are compressed once when they are cached,
+# so use the maximum. /data.lua snapshots change every few seconds.
+assetBrotliQuality    = 11
+assetGzipLevel        = 9
+snapshotBrotliQuality = 5
+snapshotGzipLevel     = 6
+compressionMinSize    = 256
+
+# browser cache lifetime of static assets. Assets with a query string are
+# versioned by it, entry pages must always be revalidated.
+assetMaxAge           = 3600
+versionedAssetMaxAge  = 365 * 24 * 3600
+
+# idle push channels send a comment every few seconds, so proxies in between
+# (e.g. the Home Assistant ingress) do not close them
+pushKeepAlive         = 30.0
+
+# number of snapshot versions for which /data.diff can answer with a patch
+luaPatchHistory       = 120
+
+# the box drops a SID after 20 minutes without use, renew it after 15.
+# Logins of an unreachable box are retried every sidRetryInterval.
+sidRenewAfter         = 900.0
+sidRetryInterval      = 30.0
+
+# number of distinct /api/links queries answered from memory per snapshot
+linkQueriesLimit      = 32
+
+# webhooks: change events of the meshes are posted to each of webhookUrls
+# in batches of at most webhookBatchSize events, gathered for
+# webhookBatchDelay seconds. A failed batch, and the events queued behind
+# it, are spooled to disk and retried after webhookRetryInterval, doubled
+# after each failure up to webhookRetryLimit. Per receiver, at most
+# webhookQueueLimit events wait in memory and webhookSpoolLimit batches on
+# disk, the oldest are dropped beyond. A link rate event is sent when the
+# faster direction of a link crosses one of linkRateThresholds (kbit/s).
+webhookUrls           = []
+linkRateThresholds    = (10000, 100000)
+webhookBatchSize      = 100
+webhookBatchDelay     = 1.0
+webhookRetryInterval  = 1.0
+webhookRetryLimit     = 300.0
+webhookQueueLimit     = 1000
+webhookSpoolLimit     = 1000
+webhookTimeout        = aiohttp.ClientTimeout(total = 10)
+
+# server side rendering of the mesh (/mesh.svg, /mesh.png): default image
+# size and the other sizes asked for in pixels, number of (format, size)
+# renderings kept per box (one of each), iterations of the force directed
+# layout after a topology change
+meshImageSize         = (1024, 768)
+meshImageSizes        = ((480, 320), (800, 480), (1024, 768), (1920, 1080))
+meshImagesLimit       = 2 * len(meshImageSizes)
+meshLayoutIterations  = 50
+
+# history tiers: (name, step, segment span, retention) in seconds. Every
+# sample is averaged into the slot of its time in each tier, so older data
+# stays available at a coarser resolution. A query uses the finest tier
+# answering it with at most historyQueryPoints points per series, for at
+# most historyQuerySeries series.
+historyTiers = [('raw',    5,    3600,       2 * 86400),
+                ('minute', 60,   86400,      30 * 86400),
+                ('hour',   3600, 30 * 86400, 730 * 86400)]
+historyQueryPoints    = 2000
+historyQuerySeries    = 16
+
+# mesh polling: while clients watch a box (open push channels, or requests
+# within the last pollIdleAfter seconds), it is polled every
+# activePollInterval, otherwise every idlePollInterval (None: not at all).
+# A slow box is polled less often, so polling keeps it busy for at most
+# pollLoadShare of the time.
+activePollInterval    = 5.0
+idlePollInterval      = 300.0
+pollIdleAfter         = 60.0
+pollLoadShare         = 0.2
+pollLatencyWeight     = 0.3
+
+# upper bucket bounds of the /metrics latency histograms, in seconds
+upstreamBuckets       = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+bootstrapBuckets      = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# upstream response headers kept in the asset store
+storedHeaderNames = ('content-type', 'etag', 'last-modified')
+
+# an asset in the asset store. Its content and the precompressed encodings
+# of it are stored as files, named by digest, the SHA-256 of the content.
+# sanitized: the content contains INGRESSREP markers to be rendered
+# fetched: time of the upstream fetch
+# firmware: Fritz!OS version the asset was fetched from, None if unknown
+# Entries are cached by (generation, path). Boxes on the same firmware
+# version share a generation, named by the version, so they share their
+# assets. Boxes of unknown firmware have a generation of their own.
+CacheEntry = namedtuple('CacheEntry', ['headers', 'digest', 'encodings', 'sanitized', 'fetched', 'firmware'])
+
+# a sanitized asset rendered for one ingress path, stored like an asset
+# bodies: None for a rendering in the asset store, else encoding -> body
+RenderedVariant = namedtuple('RenderedVariant', ['digest', 'encodings', 'bodies'])
+
+# a /data.lua snapshot. Snapshots are immutable and published by replacing
+# the snapshot of the box as a whole, so the handlers need no locks.
+# json: the parsed snapshot, the next one is diffed against it
+# event: the push channel event frame of the snapshot
+# patches: (version, JSON patch from the version before) of the last
+# luaPatchHistory versions
+# model: the MeshModel of the snapshot
+# source: hash of the upstream body it was last seen in, see processLuaData
+LuaSnapshot = namedtuple('LuaSnapshot', ['data', 'json', 'version', 'etag', 'encodings', 'event', 'patches', 'model',
+                                         'source'])
+
+emptyLuaSnapshot = LuaSnapshot(None, None, 0, None, dict(), None, (), None, None)
+
+# the mesh of a snapshot as served by the JSON API, serialized once per
+# snapshot.
+# nodes: the /api/nodes answer
+# nodeBodies: node uid -> /api/nodes/{uid} answer
+# nodeKeys: node uid, MAC address and name -> node uid
+# linkRates, links: negated rate and serialized link, by descending rate
+# linkQueries: min_rate -> /api/links answer, filled on demand
+# samples: (series, value) recorded in the history with each poll
+# events: the MeshEventState change events are derived from
+MeshModel = namedtuple('MeshModel', ['version', 'nodes', 'nodeBodies', 'nodeKeys', 'linkRates', 'links', 'linkQueries',
+                                     'samples', 'events'])
+
+# what the change events between two snapshots are derived from, see
+# meshEvents.
+# nodes: node uid -> (name, MAC address, online: any connected link)
+# uplinks: node uid -> (node uid towards the master, interface name)
+# links: link uid -> (rate, node 1 uid, node 2 uid)
+MeshEventState = namedtuple('MeshEventState', ['nodes', 'uplinks', 'links'])
+
+# node positions of the rendered mesh, in the unit square. They are kept
+# as long as the topology (node uids, linked pairs) does not change.
+MeshLayout = namedtuple('MeshLayout', ['version', 'topology', 'positions'])
+
+emptyMeshLayout = MeshLayout(0, None, dict())
+
+# a rendered mesh image of a snapshot version
+MeshImage = namedtuple('MeshImage', ['version', 'body', 'encodings', 'etag'])
+
+# the mesh history of a box, below storeDirectory/history. Each series (e.g.
+# link/<uid>/rx) has a column in the segment files of each tier: a float32
+# per step, NaN if there was no sample. Segment files grow by appending
+# the columns of new series. A series without samples for longer than a
+# tier keeps data is retired from that tier, its column is reused by the
+# next new series, so each tier has a column map of its own.
+# series: tier -> series names by column, None for a free column
+# seen: tier -> time of the last sample, by column
+# columns: tier -> series name -> column
+# slots: (tier, column) -> (slot, sum, count) of the slot being averaged
+# files: tier -> (segment start, file descriptor) of the current segment
+class History:
+  def __init__(self, directory):
+    self.directory = directory
+    self.series    = dict()
+    self.seen      = dict()
+    self.columns   = dict()
+    self.slots     = dict()
+    self.files     = dict()
+
+# a latency histogram for /metrics: counts per bucket of upstreamBuckets
+# or bootstrapBuckets, the last one counts values beyond all bounds.
+# Only updated on the event loop.
+class Histogram:
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts  = [0] * (len(buckets) + 1)
+    self.sum     = 0.0
+
+def observe(histogram, value):
+  histogram.counts[bisect_left(histogram.buckets, value)] += 1
+  histogram.sum += value
+
+# time spent in bootstrap(), per sanitized asset
+bootstrapSeconds = Histogram(bootstrapBuckets)
+
+# holds up to burst tokens, refilled at rate per second
+class TokenBucket:
+  def __init__(self, limit):
+    self.rate, self.burst = limit
+    self.tokens  = float(self.burst)
+    self.updated = time.monotonic()
+
+def takeToken(bucket):
+  now = time.monotonic()
+  bucket.tokens  = min(bucket.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+  bucket.updated = now
+  if bucket.tokens < 1:
+    return False
+  bucket.tokens -= 1
+  return True
+
+# a proxied Fritz!Box, served below prefix on the main port or on a port
+# of its own. Its cached assets are the ones of its generation.
+class FritzBox:
+  def __init__(self, name, host, username, password, port = None):
+    self.name     = name
+    self.host     = host
+    self.username = username
+    self.password = password
+    self.port     = port
+    self.prefix   = '/' + name + '/' if name and port is None else '/'
+
+    self.bootstrapSid    = invalidSid
+    self.currentSid      = invalidSid
+    self.sidUsed         = time.monotonic()
+    self.staticHash      = None
+    self.firmwareVersion = None
+    self.firmwareCheck   = None
+    self.generation      = '@' + name
+
+    # current /data.lua snapshot and its push channels
+    self.luaSnapshot     = emptyLuaSnapshot
+    self.luaSubscribers  = set()
+
+    # poll scheduler state, see pollLuaData
+    self.pollDemand      = -pollIdleAfter
+    self.pollWakeup      = None
+    self.pollInterval    = activePollInterval
+    self.pollLatency     = 0.0
+    self.polls           = 0
+    self.pollFailures    = 0
+
+    # background startup, see startBox: 'starting' (logging in, warming up),
+    # 'polling' (first poll) and 'ready'
+    self.startupState    = 'starting'
+    self.startupRetries  = 0
+
+    # instrumentation, see renderMetrics
+    self.cacheHits       = 0
+    self.cacheMisses     = 0
+    self.logins          = 0
+    self.loginFailures   = 0
+    self.negativeHits    = 0
+    self.limitedClients  = 0
+    self.limitedFetches  = 0
+    self.fetchBucket     = TokenBucket(boxFetchLimit)
+    self.upstreamSeconds = {'asset': Histogram(upstreamBuckets), 'data.lua': Histogram(upstreamBuckets)}
+
+    self.history         = None
 
-HeaderResponsePair = namedtuple('HeaderResponsePair', ['headers', 'content'])
+    # rendered mesh images, see handleMeshImage
+    self.meshLayout      = emptyMeshLayout
+    self.meshImages      = OrderedDict()
 
-def fix(contentString, pattern, repl):
-  return re.sub(pattern, repl, contentString.group(0), flags=re.S)
+# cache entries of former versions, only used to import their cache.pickle
+HeaderResponsePair = namedtuple('HeaderResponsePair', ['headers', 'content', 'segments', 'encodings', 'etag'], defaults=(None, None, None))
 
-def sanitize(images, INGRESSREP):
-  return re.sub(r':"/', r':"' + INGRESSREP, images.group(0), flags=re.S)
+# link rewriting rules of bootstrap(), applied in this order:
+# (trigger, pattern, replacement). Rules without pattern replace the plain
+# trigger string, the others are skipped unless their trigger occurs.
+bootStrapLinkRules = [
+  ('<script src="/',     None,                                  '<script src="' + INGRESSREP),
+  ('from',               re.compile(r'from\s*"/', flags=re.S),   ' from "' + INGRESSREP),
+  (' href="/',           None,                                  ' href="' + INGRESSREP),
+  ('url(',               re.compile(r':\s*url\(/', flags=re.S),  ':url(' + INGRESSREP),
+  ("url('/",             re.compile(r":\s*url\('/", flags=re.S), ": url('" + INGRESSREP),
+  ('@import',            re.compile(r'@import\s*"/', flags=re.S), '@import "' + INGRESSREP),
+  (';const script="/',   None,                                  ';const script="' + INGRESSREP),
+  ('lua"',               re.compile(r'"/?data.lua"', flags=re.S), '"' + INGRESSREP + 'data.lua"'),
+  ('src:"/',             None,                                  'src:"' + INGRESSREP),
+  ('jsl.loadCss("',      None,                                  'jsl.loadCss("' + INGRESSREP),
+  ('"/start"',           None,                                  '"' + INGRESSREP + 'start"'),
+  ('logoutWarning:true', None,                                  'logoutWarning:false'),
+]
+
+# the image map of the main page gets its "key":"/path" entries rewritten
+bootStrapImagesPattern = re.compile(r'const images\s*=\s*\{.*?\}', flags=re.S)
+
+# css / js fix rules of bootStrapConfigs, compiled once
+bootStrapRules = {path: [(re.compile(section, flags=re.S), re.compile(pattern, flags=re.S), repl)
+                         for section, pattern, repl in configs]
+                  for path, configs in bootStrapConfigs.items()}
+
+def sanitizeImages(images):
+  return images.group(0).replace(':"/', ':"' + INGRESSREP)
 
 def bootstrap(path, contentString):
   # sanitize all absolute links with ingress path ones
-  contentString = re.sub(r'<script src="/', r'<script src="' + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r'from\s*"/', r' from "' + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r' href="/', r' href="' + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r':\s*url\(/', r':url(' + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r':\s*url\(\'/', r": url('" + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r'@import\s*"/', r'@import "' + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r';const script="/', r';const script="' + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r'"/?data.lua"', r'"' + INGRESSREP + r'data.lua"', contentString, flags=re.S)
-  contentString = re.sub(r'src:"/', r'src:"' + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r'jsl\.loadCss\("', r'jsl.loadCss("' + INGRESSREP, contentString, flags=re.S)
-  contentString = re.sub(r'"/start"', r'"' + INGRESSREP + r'start"', contentString, flags=re.S)
-  contentString = re.sub(r'logoutWarning:true', r'logoutWarning:false', contentString, flags=re.S)
-  contentString = re.sub(r'(const images\s*=\s*\{(.*?)\})', lambda contentString: sanitize(contentString, INGRESSREP), contentString, flags=re.S)
-
-  if path in bootStrapConfigs:    
-    for bsConfig in bootStrapConfigs[path]:
-      contentString = re.sub(bsConfig[0], lambda contentString: fix(contentString, bsConfig[1], bsConfig[2]), contentString, flags=re.S)
+  for trigger, pattern, replacement in bootStrapLinkRules:
+    if pattern is None:
+      contentString = contentString.replace(trigger, replacement)
+    elif trigger in contentString:
+      contentString = pattern.sub(replacement, contentString)
+  if 'const images' in contentString:
+    contentString = bootStrapImagesPattern.sub(sanitizeImages, contentString)
+
+  if path in bootStrapRules:
+    for section, pattern, repl in bootStrapRules[path]:
+      contentString = section.sub(lambda match: pattern.sub(repl, match.group(0)), contentString)
+
+  if path in bootStrapInjections:
+    contentString = bootStrapInjections[path] + contentString
   
   return contentString
 
-def getResponse(path):
-  if path in entryUrls:
-    path = "/?sid=" + bootstrapSid + "&lp=meshNet"
+def compressBody(body, brotliQuality = assetBrotliQuality, gzipLevel = assetGzipLevel):
+  encodings = dict()
+  if len(body) < compressionMinSize:
+    return encodings
 
-  if path in cachedData:
-    return cachedData[path]
+  gzipBody = gzip.compress(body, compresslevel = gzipLevel, mtime = 0)
+  if len(gzipBody) < len(body):
+    encodings['gzip'] = gzipBody
+  if brotli is not None:
+    brotliBody = brotli.compress(body, quality = brotliQuality)
+    if len(brotliBody) < len(body):
+      encodings['br'] = brotliBody
+  return encodings
 
-  response = requests.get('http://' + fritzboxHost + path)
-  
-  if (path in bootStrapConfigs) or (response.headers["Content-type"] in sanitizationContentTypes):
-    contentString = str(response.content, encoding=response.encoding)
+def isCompressible(headers):
+  return headers["Content-type"].split(';')[0].strip().startswith(compressibleContentTypes)
+
+def negotiateEncoding(acceptEncoding, encodings):
+  if not acceptEncoding or not encodings:
+    return None
+
+  qualities = dict()
+  for coding in acceptEncoding.split(','):
+    name, _, params = coding.strip().partition(';')
+    quality = 1.0
+    params = params.strip()
+    if params.startswith('q='):
+      try:
+        quality = float(params[2:])
+      except ValueError:
+        quality = 0.0
+    qualities[name.strip().lower()] = quality
+
+  best, bestQuality = None, 0.0
+  for encoding in ('br', 'gzip'):
+    quality = qualities.get(encoding, qualities.get('*', 0.0))
+    if encoding in encodings and quality > bestQuality:
+      best, bestQuality = encoding, quality
+  return best
+
+def digestTag(digest):
+  return '"' + digest[:32] + '"'
+
+def contentTag(body):
+  return digestTag(hashlib.sha256(body).hexdigest())
+
+def matchesEtag(ifNoneMatch, etag):
+  if not ifNoneMatch or etag is None:
+    return False
+  # weak comparison, ignoring the content coding suffix of the representation
+  for tag in ifNoneMatch.split(','):
+    tag = tag.strip()
+    if tag == '*':
+      return True
+    tag = tag[2:] if tag.startswith('W/') else tag
+    if tag.replace('-br"', '"').replace('-gzip"', '"') == etag:
+      return True
+  return False
+
+# asset store: one file per object below storeDirectory/objects plus an
+# index of all cache entries. Files are replaced atomically, so a crash
+# never leaves a partially written object or index behind.
+def objectPath(digest, encoding = None):
+  return os.path.join(storeDirectory, 'objects', digest if encoding is None else digest + '.' + encoding)
+
+def indexPath():
+  return os.path.join(storeDirectory, 'index.json')
+
+def writeFileAtomic(filename, data, sync = True):
+  tmpFilename = filename + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+  with open(tmpFilename, 'wb') as f:
+    f.write(data)
+    f.flush()
+    if sync:
+      os.fsync(f.fileno())
+  os.replace(tmpFilename, filename)
+
+def storeBody(body, compress):
+  # returns the digest of body and the content codings stored for it.
+  # The uncompressed object is written last, its existence marks a
+  # completely stored body.
+  digest = hashlib.sha256(body).hexdigest()
+  stored = os.path.exists(objectPath(digest))
+  if stored and compress:
+    encodings = tuple(encoding for encoding in ('br', 'gzip') if os.path.exists(objectPath(digest, encoding)))
+    # the same content may have been stored uncompressed before
+    if encodings or len(body) < compressionMinSize:
+      return digest, encodings
+  elif stored:
+    return digest, ()
+
+  encodings = compressBody(body) if compress else dict()
+  for encoding, encodedBody in encodings.items():
+    writeFileAtomic(objectPath(digest, encoding), encodedBody)
+  if not stored:
+    writeFileAtomic(objectPath(digest), body)
+  return digest, tuple(encodings)
+
+def loadObject(digest, encoding = None):
+  # memory map the object, so its content is served from the page cache
+  key = (digest, encoding)
+  body = mappedObjects.get(key)
+  if body is not None:
+    mappedObjects.move_to_end(key)
+    return body
+
+  with open(objectPath(digest, encoding), 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return b''
+    body = memoryview(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+
+  # evicted mappings are unmapped once the last response using them is sent
+  mappedObjects[key] = body
+  if len(mappedObjects) > mappedObjectsLimit:
+    mappedObjects.popitem(last=False)
+  return body
+
+def readObject(digest):
+  with open(objectPath(digest), 'rb') as f:
+    return f.read()
+
+def entryItem(entry):
+  return {'headers':   list(entry.headers.items()),
+          'digest':    entry.digest,
+          'encodings': entry.encodings,
+          'sanitized': entry.sanitized,
+          'fetched':   entry.fetched,
+          'firmware':  entry.firmware}
+
+def serializeStoreIndex():
+  return json.dumps({'boxes':   {box.name: {'generation': box.generation, 'bootstrapSid': box.bootstrapSid}
+                                 for box in fritzBoxes},
+                     'entries': [dict(entryItem(entry), generation = generation, path = path)
+                                 for (generation, path), entry in cachedData.items()]},
+                    indent = 1).encode('utf-8')
+
+def writeStoreIndex(serial, index):
+  # index writes may finish out of order, never replace a newer index
+  global storeIndexSaved
+  with storeIndexLock:
+    if serial > storeIndexSaved:
+      writeFileAtomic(indexPath(), index)
+      storeIndexSaved = serial
+
+async def saveStoreIndex():
+  global storeIndexSerial
+  storeIndexSerial += 1
+  await asyncio.get_running_loop().run_in_executor(
+      None, writeStoreIndex, storeIndexSerial, serializeStoreIndex())
+
+def importLegacyCache(cacheFilename):
+  # convert the cache.pickle of former versions into a single box index.
+  # Its headers may be of classes that are not installed (e.g. of requests):
+  # then the assets are fetched again.
+  index = dict()
+  try:
+    with open(cacheFilename, 'rb') as f:
+      legacyData = pickle.load(f)
+    fetched = os.path.getmtime(cacheFilename)
+    for path, pair in legacyData.items():
+      headers = CIMultiDict(pair.headers)
+      index[path] = entryItem(createCacheEntry(path, headers, pair.content, isSanitized(path, headers), fetched, None))
+  except Exception as e:
+    print('could not import', cacheFilename + ', starting with an empty cache:', repr(e), file=sys.stderr)
+    index = dict()
+  os.remove(cacheFilename)
+  return index
+
+def readStoreIndex(legacyCacheFilename):
+  try:
+    with open(indexPath(), 'rb') as f:
+      index = json.load(f)
+  except (IOError, ValueError):
+    if legacyCacheFilename is None or not os.path.exists(legacyCacheFilename):
+      return {'boxes': {}, 'entries': []}
+    index = importLegacyCache(legacyCacheFilename)
+
+  if 'entries' not in index:
+    # index of a single box store (path -> entry), it belongs to the main box
+    entries = [dict(item, generation = item['firmware'] or '@', path = path) for path, item in index.items()]
+    index = {'boxes': {}, 'entries': entries}
+    for item in entries:
+      if item['path'].startswith('/?sid='):
+        query = dict(parse_qsl(urlparse(item['path']).query))
+        index['boxes'][''] = {'generation': item['generation'], 'bootstrapSid': query['sid']}
+  return index
+
+def restoreStoreIndex(index):
+  try:
+    for item in index['entries']:
+      cachedData[(item['generation'], item['path'])] = CacheEntry(
+          CIMultiDict(item['headers']), item['digest'], tuple(item['encodings']),
+          item['sanitized'], item['fetched'], item['firmware'])
+    for box in fritzBoxes:
+      if box.name in index['boxes']:
+        box.generation   = index['boxes'][box.name]['generation']
+        box.bootstrapSid = index['boxes'][box.name]['bootstrapSid']
+  except (KeyError, TypeError):
+    cachedData.clear()
+
+def openAssetStore(legacyCacheFilename = None):
+  global storeIndexSerial
+  os.makedirs(os.path.join(storeDirectory, 'objects'), exist_ok = True)
+
+  # only the index is read, the objects stay on disk
+  restoreStoreIndex(readStoreIndex(legacyCacheFilename))
+
+  # forget entries with missing objects, delete objects of no entry (e.g.
+  # rendered variants, which are recreated on demand)
+  referenced = set()
+  for key, entry in list(cachedData.items()):
+    try:
+      referenceObjects(entry.digest, entry.encodings)
+      referenced.add(os.path.basename(objectPath(entry.digest)))
+      referenced.update(os.path.basename(objectPath(entry.digest, encoding)) for encoding in entry.encodings)
+    except FileNotFoundError:
+      del cachedData[key]
+  for name in os.listdir(os.path.join(storeDirectory, 'objects')):
+    if name not in referenced:
+      os.remove(os.path.join(storeDirectory, 'objects', name))
+  evictCacheEntries()
+
+  storeIndexSerial += 1
+  writeStoreIndex(storeIndexSerial, serializeStoreIndex())
+
+# the objects of a digest are deleted with the last cache entry or stored
+# rendering referring to it.
+# storedDigests: digest -> [references, bytes of its objects, their encodings]
+def referenceObjects(digest, encodings):
+  global storeBytes
+  stored = storedDigests.get(digest, [0, 0, set()])
+  # a rendering may add content codings to an object stored uncompressed
+  added = [encoding for encoding in (None,) + tuple(encodings) if encoding not in stored[2]]
+  size  = sum(os.path.getsize(objectPath(digest, encoding)) for encoding in added)
+  storedDigests[digest] = stored
+  stored[0] += 1
+  stored[1] += size
+  stored[2].update(added)
+  storeBytes += size
+
+def releaseObjects(digest):
+  global storeBytes
+  stored = storedDigests.get(digest)
+  if stored is None:
+    return
+  stored[0] -= 1
+  if stored[0] > 0:
+    return
+  del storedDigests[digest]
+  storeBytes -= stored[1]
+  for encoding in (None, 'br', 'gzip'):
+    mappedObjects.pop((digest, encoding), None)
+    try:
+      os.remove(objectPath(digest, encoding))
+    except FileNotFoundError:
+      pass
+  # renderings are recreated on demand
+  for variantKey in [variantKey for variantKey in renderedVariants if variantKey[0] == digest]:
+    dropVariant(variantKey)
+
+def putCacheEntry(key, entry):
+  referenceObjects(entry.digest, entry.encodings)
+  forgetCacheEntry(key)
+  cachedData[key] = entry
+  evictCacheEntries()
+
+def forgetCacheEntry(key):
+  entry = cachedData.pop(key, None)
+  if entry is not None:
+    releaseObjects(entry.digest)
+
+def evictCacheEntries():
+  # renderings first, they are recreated on demand. Then the least recently
+  # used entries, the newest entry and rendering always stay.
+  variantKeys = [key for key, variant in renderedVariants.items() if variant.bodies is None][:-1]
+  while storeBytes > storeByteLimit and variantKeys:
+    dropVariant(variantKeys.pop(0))
+  while storeBytes > storeByteLimit and len(cachedData) > 1:
+    forgetCacheEntry(next(iter(cachedData)))
+
+def isSanitized(path, headers):
+  return (path in bootStrapConfigs) or (headers["Content-type"] in sanitizationContentTypes)
+
+def createCacheEntry(path, headers, content, sanitized, fetched, firmware):
+  digest, encodings = storeBody(content, compress = not sanitized and isCompressible(headers))
+  headers = CIMultiDict((name, value) for name, value in headers.items() if name.lower() in storedHeaderNames)
+  return CacheEntry(headers, digest, encodings, sanitized, fetched, firmware)
+
+def processResponse(path, headers, content, encoding, sid, bootstrapSid, firmware):
+  # returns the new cache entry and the time bootstrap() took, None if the
+  # asset is not sanitized
+  sanitized = isSanitized(path, headers)
+  bootstrapTime = None
+  if sanitized:
+    contentString = str(content, encoding=encoding)
+    if sid is not None:
+      # fetched with another SID than the one it is cached under
+      contentString = contentString.replace(sid, bootstrapSid)
+    start = time.perf_counter()
     contentString = bootstrap(path, contentString)
+    bootstrapTime = time.perf_counter() - start
     content = bytes(contentString, 'utf-8')
-  else:
-    content = response.content
 
-  myPair = HeaderResponsePair(response.headers, content)
+  return createCacheEntry(path, headers, content, sanitized, time.time(), firmware), bootstrapTime
 
-  cachedData[path] = myPair
-  return myPair
+def upstreamPath(box, path, sid):
+  # pages are cached under the bootstrap SID, which may have expired
+  # meanwhile. Fetch them with the current one.
+  if sid != box.bootstrapSid and '?sid=' + box.bootstrapSid in path:
+    return path.replace('?sid=' + box.bootstrapSid, '?sid=' + sid, 1)
+  return path
 
-async def do_GET(request):
-  responseHeaders, responseContent = getResponse(request.url.path_qs)
-  
-  if responseHeaders["Content-type"] in sanitizationContentTypes:
+def conditionalHeaders(entry):
+  headers = dict()
+  if 'etag' in entry.headers:
+    headers['If-None-Match'] = entry.headers['etag']
+  if 'last-modified' in entry.headers:
+    headers['If-Modified-Since'] = entry.headers['last-modified']
+  return headers
+
+async def streamBody(path, headers, response, request, stream):
+  # forward the upstream response to the client as it arrives, returning
+  # its content. Content larger than streamCacheLimit is only forwarded,
+  # None is returned then. A client closing its connection does not stop
+  # the content from being read for the cache.
+  stream.content_type = headers['Content-type'].split(';')[0]
+  stream.headers['Cache-Control'] = assetCacheControl(path)
+  if 'Content-Length' in headers and 'Content-Encoding' not in headers:
+    stream.content_length = int(headers['Content-Length'])
+  forwarding = True
+  try:
+    await stream.prepare(request)
+  except ConnectionError:
+    forwarding = False
+
+  chunks = []
+  size   = 0
+  async for chunk in response.content.iter_any():
+    if forwarding:
+      try:
+        await stream.write(chunk)
+      except ConnectionError:
+        forwarding = False
+    if chunks is not None:
+      size += len(chunk)
+      if size <= streamCacheLimit:
+        chunks.append(chunk)
+      else:
+        chunks = None
+    if chunks is None and not forwarding:
+      break
+  if forwarding:
+    await stream.write_eof()
+  return b''.join(chunks) if chunks is not None else None
+
+async def fetchEntry(box, path, previous = None, request = None, stream = None):
+  # fetch path from the box into a new cache entry. Given the previous
+  # entry, the request is conditional: an unchanged asset keeps its stored
+  # objects, a removed one (404) returns None. Other failures raise.
+  # Given a client request and its unprepared stream response, an asset
+  # that is not sanitized is streamed to it, see streamBody. It returns
+  # None if the asset is too large to be cached.
+  sid = box.currentSid
+  upstream = upstreamPath(box, path, sid)
+  requestHeaders = conditionalHeaders(previous) if previous is not None else None
+  start = time.perf_counter()
+  async with upstreamSession.get('http://' + box.host + upstream, headers = requestHeaders) as response:
+    if previous is not None:
+      if response.status == 304:
+        observe(box.upstreamSeconds['asset'], time.perf_counter() - start)
+        return previous._replace(fetched = time.time(), firmware = box.firmwareVersion)
+      if response.status == 404:
+        return None
+    response.raise_for_status()
+    headers  = CIMultiDict(response.headers)
+    encoding = None
+    if stream is not None and response.status == 200 and not isSanitized(path, headers):
+      content = await streamBody(path, headers, response, request, stream)
+    else:
+      content  = await response.read()
+      encoding = response.get_encoding()
+  observe(box.upstreamSeconds['asset'], time.perf_counter() - start)
+  if content is None:
+    return None
+
+  # bootstrapping, compression and storing are CPU / IO heavy, keep them
+  # off the event loop
+  entry, bootstrapTime = await asyncio.get_running_loop().run_in_executor(
+      None, processResponse, path, headers, content, encoding,
+      sid if upstream != path else None, box.bootstrapSid, box.firmwareVersion)
+  if bootstrapTime is not None:
+    observe(bootstrapSeconds, bootstrapTime)
+  return entry
+
+async def fetchResponse(box, key, request = None, stream = None):
+  try:
+    entry = await fetchEntry(box, key[1], request = request, stream = stream)
+  except aiohttp.ClientResponseError as e:
+    failedFetches[key] = (time.monotonic() + negativeCacheTtl, e)
+    if len(failedFetches) > negativeCacheLimit:
+      failedFetches.popitem(last = False)
+    raise
+  if entry is not None:
+    putCacheEntry(key, entry)
+    await saveStoreIndex()
+  return entry
+
+def singleFlight(pending, key, factory):
+  # coalesce concurrent requests: all callers for the same key
+  # wait for a single execution of factory()
+  future = pending.get(key)
+  if future is None:
+    future = asyncio.ensure_future(factory())
+    pending[key] = future
+    future.add_done_callback(lambda _: pending.pop(key, None))
+
+  # shield the shared work from cancellation of a single waiting client
+  return asyncio.shield(future)
+
+def cachePath(box, path):
+  if path in entryUrls:
+    return "/?sid=" + box.bootstrapSid + "&lp=meshNet"
+  if '?' in path:
+    return normalizeQuery(box, path)
+  return path
+
+def normalizeQuery(box, path):
+  # equivalent query strings share a cache key: the SID first, the other
+  # parameters ordered by name. Pages are fetched with the SID of the
+  # daemon anyway, so any SID is the bootstrap one.
+  path, _, query = path.partition('?')
+  parameters = sorted(parse_qsl(query, keep_blank_values = True), key = lambda parameter: (parameter[0] != 'sid', parameter[0]))
+  parameters = [(name, box.bootstrapSid if name == 'sid' else value) for name, value in parameters]
+  return path + '?' + urlencode(parameters, safe = '/,:') if parameters else path
+
+def isBoxAsset(box, path):
+  # the main pages of other boxes are cached in the same generation
+  return not path.startswith('/?sid=') or path == cachePath(box, '/')
+
+async def getResponse(box, key, request = None, stream = None):
+  # key: (generation, cache path). Boxes of the same generation share
+  # their fetches. Given a client request and an unprepared stream
+  # response, a fetch started for it may stream the asset to it instead,
+  # see fetchEntry. Returns None if it is not cached then.
+  if key in cachedData:
+    box.cacheHits += 1
+    cachedData.move_to_end(key)
+    return cachedData[key]
+
+  failure = failedFetches.get(key)
+  if failure is not None:
+    if failure[0] > time.monotonic():
+      box.negativeHits += 1
+      raise failure[1].with_traceback(None)
+    del failedFetches[key]
+
+  box.cacheMisses += 1
+  while True:
+    entry = await singleFlight(pendingFetches, key, lambda: fetchResponse(box, key, request, stream))
+    # the shared fetch streamed an uncached asset to another client
+    if entry is not None or (stream is not None and stream.prepared):
+      return entry
+
+async def warmUp(box):
+  # get a valid login and sid from the box
+  mySid = await login(box)
+  if (mySid == invalidSid):
+    print("Could not access Fritzbox " + box.host + ".", file=sys.stderr)
+    return False
+
+  if (box.bootstrapSid == invalidSid):
+    # we got a valid sid for the first time. 
+    box.bootstrapSid = mySid
+
+  # make sure main page is cached with bootstrap SID, tagged with the
+  # firmware it is fetched from
+  box.firmwareVersion = await fetchFirmwareVersion(box)
+  if box.firmwareVersion is not None and all(generation != box.generation for generation, _ in cachedData):
+    # nothing cached for the box yet, start with the generation of its firmware
+    box.generation = box.firmwareVersion
+  await prefetchAssets(box)
+  return True
+
+# references of the prefetch crawler: links rewritten by bootstrap(), and
+# module imports and stylesheet urls relative to the asset
+crawledContentTypes   = ('text/html', 'text/css', 'application/javascript', 'text/javascript')
+ingressLinkPattern    = re.compile(re.escape(INGRESSREP) + r'([^"\'`\s)]+)')
+relativeImportPattern = re.compile(r'\b(?:from|import)\s*\(?\s*["\'](\.{1,2}/[^"\']+)["\']')
+relativeUrlPattern    = re.compile(r'(?:url\(\s*["\']?|@import\s*["\'])(?!data:|[a-z]+:|/|#|' + re.escape(INGRESSREP) + r')([^"\')\s]+)')
+
+def isPrefetched(path):
+  return path.startswith('/') and not path.startswith('//') and urlparse(path).path.lower().endswith(prefetchExtensions)
+
+def assetReferences(path, contentType, digest):
+  body = readObject(digest).decode('utf-8', errors = 'replace')
+  references = ['/' + link for link in ingressLinkPattern.findall(body)]
+  references += [urljoin(path, link) for link in relativeImportPattern.findall(body)]
+  if contentType.startswith('text/css'):
+    references += [urljoin(path, link) for link in relativeUrlPattern.findall(body)]
+  references = (reference.split('#')[0] for reference in references)
+  return {reference for reference in references if isPrefetched(reference)}
+
+async def prefetchAsset(box, path, crawl, semaphore):
+  # returns the assets referenced by path, None if it could not be fetched
+  async with semaphore:
+    try:
+      entry = await getResponse(box, (box.generation, cachePath(box, path)))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      print('could not prefetch', path, 'from', box.host + ':', repr(e), file=sys.stderr)
+      return None
+    contentType = entry.headers.get('Content-type', '')
+    if not crawl or not contentType.startswith(crawledContentTypes):
+      return set()
+    try:
+      return await asyncio.get_running_loop().run_in_executor(None, assetReferences, path, contentType, entry.digest)
+    except OSError as e:
+      print('could not crawl', path + ':', repr(e), file=sys.stderr)
+      return set()
+
+async def prefetchAssets(box):
+  # fetch the main page and the assets it pulls in, before the box is
+  # ready. Without a manifest of the box generation, the assets are found
+  # by crawling the main page, the scripts and the stylesheets, and saved
+  # as its manifest. Later starts fetch the manifest without crawling.
+  mainPage  = cachePath(box, '/')
+  manifest  = assetManifests.get(box.generation)
+  crawl     = manifest is None and prefetchConcurrency > 0
+  paths     = {mainPage}
+  if prefetchConcurrency > 0 and manifest is not None:
+    paths.update(manifest)
+  semaphore = asyncio.Semaphore(max(prefetchConcurrency, 1))
+  tasks     = {asyncio.ensure_future(prefetchAsset(box, path, crawl, semaphore)): path for path in paths}
+  fetched   = []
+  while tasks:
+    done, _ = await asyncio.wait(tasks, return_when = asyncio.FIRST_COMPLETED)
+    for task in done:
+      path = tasks.pop(task)
+      references = task.result()
+      if references is None:
+        continue
+      fetched.append(path)
+      for reference in references - paths:
+        if len(paths) < prefetchLimit:
+          paths.add(reference)
+          tasks[asyncio.ensure_future(prefetchAsset(box, reference, crawl, semaphore))] = reference
+
+  if crawl:
+    assetManifests[box.generation] = sorted(path for path in fetched if path != mainPage)
+    saveManifests()
+  if len(fetched) > 1:
+    print('prefetched', len(fetched), 'assets of', box.host, file=sys.stderr)
+
+def manifestPath():
+  return manifestFilename or os.path.join(storeDirectory, 'manifest.json')
+
+def readManifests():
+  # generation -> asset paths of the main page
+  try:
+    with open(manifestPath(), 'rb') as f:
+      assetManifests.update(json.loads(f.read()))
+  except FileNotFoundError:
+    pass
+  except (OSError, ValueError) as e:
+    print('could not read the asset manifest:', repr(e), file=sys.stderr)
+
+def saveManifests():
+  # only the manifests of generations in use are kept
+  manifests = {generation: paths for generation, paths in assetManifests.items()
+               if any(box.generation == generation for box in fritzBoxes)}
+  try:
+    writeFileAtomic(manifestPath(), json.dumps(manifests, indent = 1).encode('utf-8'))
+  except OSError as e:
+    print('could not save the asset manifest:', repr(e), file=sys.stderr)
+
+async def upstreamContext(app):
+  global upstreamSession
+  upstreamSession = aiohttp.ClientSession(
+      connector = aiohttp.TCPConnector(limit_per_host = upstreamConnections),
+      timeout   = upstreamTimeout)
+
+  readManifests()
+
+  yield
+
+  await upstreamSession.close()
+
+def parseFirmwareVersion(boxInfo):
+  # e.g. <j:Version>154.07.57</j:Version> <j:Revision>107059</j:Revision>
+  root = ElementTree.fromstring(boxInfo)
+  version = root.findtext(boxInfoNamespace + 'Version')
+  if not version:
+    return None
+  revision = root.findtext(boxInfoNamespace + 'Revision')
+  return version + '-' + revision if revision else version
+
+async def fetchFirmwareVersion(box):
+  # the box info is available without login
+  try:
+    async with upstreamSession.get('http://' + box.host + '/jason_boxinfo.xml') as response:
+      if response.status != 200:
+        return None
+      return parseFirmwareVersion(await response.read())
+  except (aiohttp.ClientError, asyncio.TimeoutError, ElementTree.ParseError):
+    return None
+
+async def revalidateEntry(box, path, entry, limit):
+  async with limit:
+    return path, await fetchEntry(box, path, entry)
+
+async def revalidateCache(box, firmware):
+  # move the box to the generation of its new firmware. Its assets missing
+  # in there are revalidated against the box. Clients are served the old
+  # generation until every asset is revalidated and bootstrapped, then the
+  # box switches to the new generation at once. A generation no box uses
+  # any more is dropped, with the objects only it refers to.
+  stale = {path: entry for (generation, path), entry in cachedData.items()
+           if generation == box.generation and isBoxAsset(box, path) and (firmware, path) not in cachedData}
+
+  changed = 0
+  if stale:
+    print('revalidating', len(stale), 'cached assets of', box.host, 'for firmware', firmware, file=sys.stderr)
+    limit = asyncio.Semaphore(revalidationRequests)
+    revalidated = await asyncio.gather(*(revalidateEntry(box, path, entry, limit) for path, entry in stale.items()),
+                                       return_exceptions = True)
+    failures = [result for result in revalidated if isinstance(result, Exception)]
+    if failures:
+      # keep the old generation, retry with the next firmware check
+      print('revalidation failed:', repr(failures[0]), file=sys.stderr)
+      return
+
+    for path, entry in revalidated:
+      if entry is not None:
+        putCacheEntry((firmware, path), entry)
+      if entry is None or entry.digest != stale[path].digest:
+        changed += 1
+
+  oldGeneration, box.generation = box.generation, firmware
+  if all(other.generation != oldGeneration for other in fritzBoxes):
+    for key in [key for key in cachedData if key[0] == oldGeneration]:
+      forgetCacheEntry(key)
+  await saveStoreIndex()
+  if stale:
+    print('revalidated cache of', box.host + ',', changed, 'assets changed', file=sys.stderr)
+
+async def watchFirmware(box):
+  # the first check follows the warm up of the box, see startBox
+  while True:
+    try:
+      await asyncio.wait_for(box.firmwareCheck.wait(), firmwareCheckInterval)
+    except asyncio.TimeoutError:
+      pass
+    box.firmwareCheck.clear()
+    if box.startupState == 'starting':
+      continue
+
+    firmware = await fetchFirmwareVersion(box)
+    if firmware is not None:
+      if firmware != box.firmwareVersion:
+        print('firmware version of', box.host + ':', firmware, file=sys.stderr)
+        box.firmwareVersion = firmware
+      if firmware != box.generation:
+        await revalidateCache(box, firmware)
+
+def wakeFirmwareCheck(box):
+  if box.firmwareCheck is not None:
+    box.firmwareCheck.set()
+
+async def stopTasks(tasks):
+  for task in tasks:
+    task.cancel()
+  await asyncio.gather(*tasks, return_exceptions = True)
+
+async def revalidationContext(app):
+  for box in fritzBoxes:
+    box.firmwareCheck = asyncio.Event()
+  watchers = [asyncio.ensure_future(watchFirmware(box)) for box in fritzBoxes]
+
+  yield
+
+  await stopTasks(watchers)
+  for box in fritzBoxes:
+    box.firmwareCheck = None
+
+def storesVariants(ingressPath):
+  # whether the renderings for ingressPath go to the asset store. Only the
+  # owner stores them, workers do not account for the store.
+  if not storeOwner:
+    return False
+  if any(ingressPath == box.prefix for box in fritzBoxes):
+    return True
+  if ingressPath in storedPaths:
+    storedPaths.move_to_end(ingressPath)
+    return True
+
+  hits = ingressPathHits.pop(ingressPath, 0) + 1
+  if hits < ingressPathPromotion:
+    ingressPathHits[ingressPath] = hits
+    if len(ingressPathHits) > ingressPathsLimit:
+      ingressPathHits.popitem(last=False)
+    return False
+
+  storedPaths[ingressPath] = True
+  if len(storedPaths) > storedIngressPathsLimit:
+    demoted, _ = storedPaths.popitem(last=False)
+    for variantKey in [variantKey for variantKey in renderedVariants if variantKey[1] == demoted]:
+      dropVariant(variantKey)
+  return True
+
+def createVariant(digest, ingressPath, stored):
+  body = ingressPath.encode('utf-8').join(readObject(digest).split(INGRESSREP_BYTES))
+  if stored:
+    return RenderedVariant(*storeBody(body, compress = True), None)
+  bodies    = compressBody(body, snapshotBrotliQuality, snapshotGzipLevel)
+  encodings = tuple(bodies)
+  bodies[None] = body
+  return RenderedVariant(hashlib.sha256(body).hexdigest(), encodings, bodies)
+
+def dropVariant(key):
+  variant = renderedVariants.pop(key, None)
+  if variant is not None and variant.bodies is None:
+    releaseObjects(variant.digest)
+
+async def addVariant(key, stored):
+  variant = await asyncio.get_running_loop().run_in_executor(None, createVariant, key[0], key[1], stored)
+  if stored:
+    referenceObjects(variant.digest, variant.encodings)
+  dropVariant(key)
+  renderedVariants[key] = variant
+  while len(renderedVariants) > renderedVariantsLimit:
+    dropVariant(next(iter(renderedVariants)))
+  evictCacheEntries()
+  return variant
+
+async def renderVariant(entry, ingressPath):
+  # renderings only depend on the content, boxes share them
+  key     = (entry.digest, ingressPath)
+  stored  = storesVariants(ingressPath)
+  variant = renderedVariants.get(key)
+  if variant is not None and (variant.bodies is None) == stored:
+    renderedVariants.move_to_end(key)
+    return variant
+
+  return await singleFlight(pendingVariants, key + (stored,), lambda: addVariant(key, stored))
+
+def assetCacheControl(path):
+  if path.startswith('/?sid='):
+    return 'no-cache'
+  if '?' in path and not 'sid=' in path:
+    return 'max-age=' + str(versionedAssetMaxAge) + ', immutable'
+  return 'max-age=' + str(assetMaxAge)
+
+def encodedResponse(request, encodings, loadBody, etag, contentType, cacheControl = None):
+  # encodings: the available content codings besides identity,
+  # loadBody(encoding): body in the given coding, None for identity
+  encoding = negotiateEncoding(request.headers.get('Accept-Encoding'), encodings)
+
+  headers = dict()
+  if encodings is not None:
+    headers['Vary'] = 'Accept-Encoding'
+  if encoding is not None:
+    headers['Content-Encoding'] = encoding
+  if etag is not None:
+    # every content coding is a representation of its own
+    headers['ETag'] = etag if encoding is None else etag[:-1] + '-' + encoding + '"'
+  if cacheControl is not None:
+    headers['Cache-Control'] = cacheControl
+
+  if matchesEtag(request.headers.get('If-None-Match'), etag):
+    return web.Response(status = 304, headers = headers)
+
+  return web.Response(
+      body = loadBody(encoding),
+      content_type = contentType,
+      headers = headers)
+
+async def do_GET(box, request):
+  # path below the prefix of the box
+  path = cachePath(box, request.url.path_qs[len(box.prefix) - 1:])
+
+  for attempt in range(2):
+    key = (box.generation, path)
+    stream = None
+    if key not in cachedData and path.startswith('/?sid=') and box.currentSid == invalidSid:
+      # not logged in yet: the box would answer with its login page
+      raise web.HTTPServiceUnavailable()
+    if key not in cachedData:
+      admitFetch(box, request, key)
+      stream = web.StreamResponse()
+    try:
+      entry = await getResponse(box, key, request, stream)
+    except aiohttp.ClientResponseError as e:
+      return web.Response(status = e.status, text = e.message)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      # not cached and the box is not reachable (yet)
+      if stream is not None and stream.prepared:
+        raise
+      raise web.HTTPBadGateway(text = 'Fritzbox ' + box.host + ' not reachable: ' + repr(e))
+    if stream is not None and stream.prepared:
+      return stream
+
+    try:
+      return await cachedResponse(box, request, path, entry)
+    except FileNotFoundError:
+      # object removed from the store behind our back: fetch it again
+      forgetCacheEntry(key)
+
+  raise web.HTTPServiceUnavailable()
+
+def clientAddress(request):
+  # requests of workers arrive on a unix socket, see forwardToOwner
+  address = request.remote or request.headers.get('X-Fritzmesh-Client', '')
+  if address in trustedProxies:
+    for forwarded in reversed(request.headers.get('X-Forwarded-For', '').split(',')):
+      address = forwarded.strip() or address
+      if address not in trustedProxies:
+        break
+  return address
+
+def admitFetch(box, request, key):
+  # a cache miss nobody fetches yet takes a token of its client and of the box
+  if key in pendingFetches or key in failedFetches:
+    return
+  address = clientAddress(request)
+  bucket  = clientBuckets.get(address)
+  if bucket is None:
+    bucket = clientBuckets[address] = TokenBucket(clientFetchLimit)
+    if len(clientBuckets) > clientBucketsLimit:
+      clientBuckets.popitem(last = False)
+  else:
+    clientBuckets.move_to_end(address)
+
+  if not takeToken(bucket):
+    box.limitedClients += 1
+    raise web.HTTPTooManyRequests(headers = {'Retry-After': '1'})
+  if not takeToken(box.fetchBucket):
+    box.limitedFetches += 1
+    raise web.HTTPTooManyRequests(headers = {'Retry-After': '1'})
+
+async def cachedResponse(box, request, path, entry):
+  digest, encodings, bodies = entry.digest, entry.encodings, None
+  if entry.sanitized:
     ingressPath = request.headers.get('x-ingress-path')
     if ingressPath is None:
       ingressPath = ''
-    ingressPath += '/'
-    
-    responseString  = str(responseContent, 'utf-8')
-    responseString  = responseString.replace(INGRESSREP, ingressPath)
-    responseContent = bytes(responseString, 'utf-8')
+    # the ingress path ends up in the rendered scripts and pages
+    if not ingressPathPattern.fullmatch(ingressPath):
+      raise web.HTTPBadRequest(text = 'invalid X-Ingress-Path')
+    ingressPath += box.prefix
+
+    digest, encodings, bodies = await renderVariant(entry, ingressPath)
+
+  contenType = entry.headers["Content-type"].split(';')[0]
+  loadBody   = bodies.get if bodies is not None else lambda encoding: loadObject(digest, encoding)
+  return encodedResponse(request, encodings, loadBody, digestTag(digest), contenType, assetCacheControl(path))
+
+async def redirectToPrefix(box, request):
+  # relative, so it works below an ingress path as well
+  raise web.HTTPMovedPermanently(box.name + '/')
+
+async def handleLuaDataRequest(box, request):
+  # pollers sending the ETag of their last snapshot get a 304 as long as
+  # the mesh did not change
+  noteDemand(box)
+  if box.luaSnapshot.data is None:
+    # not polled yet and no snapshot of the previous run
+    raise web.HTTPServiceUnavailable()
+  response = luaDataResponse(request, box.luaSnapshot)
+  if box.startupState != 'ready':
+    # the snapshot of the previous run, the box was not polled yet
+    response.headers['Warning'] = '110 - "Response is Stale"'
+  return response
+
+def luaDataResponse(request, snapshot):
+  return encodedResponse(request, snapshot.encodings,
+                         lambda encoding: snapshot.data if encoding is None else snapshot.encodings[encoding],
+                         snapshot.etag, 'application/json')
+
+def wakeLuaSubscribers(box):
+  for wakeup in box.luaSubscribers:
+    wakeup.set()
+
+def luaChangesSince(snapshot, since):
+  # JSON patch from snapshot version since to the given one, or the full
+  # snapshot if since is unknown or too old
+  version = snapshot.version
+  oldest  = snapshot.patches[0][0] if snapshot.patches else version + 1
+  if since is not None and since == version:
+    patches = []
+  elif since is not None and oldest <= since + 1 <= version:
+    patches = [patch for _, patch in snapshot.patches[since + 1 - oldest:] if patch]
+  else:
+    return b'{"version":' + str(version).encode() + b',"snapshot":' + (snapshot.data or b'null') + b'}'
 
+  return (b'{"version":' + str(version).encode() + b',"since":' + str(since).encode()
+          + b',"patch":[' + b','.join(patches) + b']}')
+
+def parseVersion(version):
   try:
-    contenType = responseHeaders["Content-type"].split(';')[0]
-    return web.Response(
-        body = responseContent,
-        content_type = contenType)
-  except IOError:
-    pass
+    return int(version)
+  except (TypeError, ValueError):
+    return None
+
+async def handleLuaDiffRequest(box, request):
+  noteDemand(box)
+  return web.Response(
+      body = luaChangesSince(box.luaSnapshot, parseVersion(request.query.get('since'))),
+      content_type = 'application/json',
+      headers = {'Cache-Control': 'no-cache'})
+
+def apiResponse(body):
+  return web.Response(body = body, content_type = 'application/json', headers = {'Cache-Control': 'no-cache'})
+
+def meshModel(box):
+  noteDemand(box)
+  model = box.luaSnapshot.model
+  if model is None:
+    raise web.HTTPServiceUnavailable()
+  return model
+
+async def handleApiNodes(box, request):
+  return apiResponse(meshModel(box).nodes)
+
+async def handleApiNode(box, request):
+  # a node by uid, MAC address or name
+  model = meshModel(box)
+  key = request.match_info['key']
+  uid = model.nodeKeys.get(key, model.nodeKeys.get(key.upper()))
+  if uid is None:
+    raise web.HTTPNotFound(text = '{"error":"unknown node"}', content_type = 'application/json')
+  return apiResponse(model.nodeBodies[uid])
+
+async def handleApiLinks(box, request):
+  model = meshModel(box)
+  try:
+    minRate = float(request.query.get('min_rate', 0))
+  except ValueError:
+    raise web.HTTPBadRequest(text = '{"error":"invalid min_rate"}', content_type = 'application/json')
+  return apiResponse(queryLinks(model, minRate))
+
+async def handleApiHistory(box, request):
+  # ?series=<name>&series=...&from=<time>&to=<time>, times in seconds since
+  # the epoch, default: the last day. Without series, the names of all
+  # recorded series.
+  names = list(OrderedDict.fromkeys(request.query.getall('series', [])))
+  if len(names) > historyQuerySeries:
+    raise web.HTTPBadRequest(text = '{"error":"too many series"}', content_type = 'application/json')
+  if not names:
+    # the last tier keeps data longest, it has a column for all series
+    series = list(box.history.columns[historyTiers[-1][0]]) if box.history else []
+    return apiResponse(json.dumps({'series': series}).encode('utf-8'))
+  if box.history is None:
+    raise web.HTTPServiceUnavailable()
+
+  now = time.time()
+  try:
+    start = float(request.query.get('from', now - 86400))
+    end   = float(request.query.get('to', now))
+  except ValueError:
+    raise web.HTTPBadRequest(text = '{"error":"invalid time range"}', content_type = 'application/json')
+  if not -1e12 < start <= end < 1e12:
+    raise web.HTTPBadRequest(text = '{"error":"invalid time range"}', content_type = 'application/json')
+  # there are no samples after now, do not look for their segments
+  end = min(end, now)
+
+  return apiResponse(await asyncio.get_running_loop().run_in_executor(
+      None, queryHistory, box.history, names, start, end))
 
-async def handleLuaDataRequest(request):
-  global luaData, dataLock
-  with dataLock:
-    return web.Response(
-        body = luaData,
-        content_type = 'application/json')
+def meshTopology(luaJson):
+  nodes = sorted(str(node['uid']) for node in meshNodes(luaJson))
+  known = set(nodes)
+  edges = set()
+  for node in meshNodes(luaJson):
+    for link in nodeLinks(node):
+      ends = tuple(sorted((str(link.get('node_1_uid')), str(link.get('node_2_uid')))))
+      if ends[0] != ends[1] and known.issuperset(ends):
+        edges.add(ends)
+  return tuple(nodes), tuple(sorted(edges))
+
+def hashedAngle(uid):
+  # a stable direction per node, python's hash() differs per process
+  return zlib.crc32(uid.encode('utf-8')) % 3600 / 3600 * 2 * math.pi
+
+def layoutMesh(layout, version, luaJson):
+  # incremental force directed layout (Fruchterman-Reingold): known nodes
+  # keep their position and move only slightly, new ones start next to
+  # their placed neighbours. An unchanged topology keeps the layout.
+  topology = meshTopology(luaJson)
+  if topology == layout.topology:
+    return layout._replace(version = version)
+  uids, edges = topology
+
+  neighbours = {uid: [] for uid in uids}
+  for uid1, uid2 in edges:
+    neighbours[uid1].append(uid2)
+    neighbours[uid2].append(uid1)
+  positions = {uid: layout.positions[uid] for uid in uids if uid in layout.positions}
+  known     = set(positions)
+  pending   = [uid for uid in uids if uid not in positions]
+  while pending:
+    uid = next((uid for uid in pending if any(other in positions for other in neighbours[uid])), pending[0])
+    pending.remove(uid)
+    placed = [positions[other] for other in neighbours[uid] if other in positions]
+    angle  = hashedAngle(uid)
+    if placed:
+      x, y = sum(p[0] for p in placed) / len(placed), sum(p[1] for p in placed) / len(placed)
+      positions[uid] = (x + 0.1 * math.cos(angle), y + 0.1 * math.sin(angle))
+    else:
+      positions[uid] = (0.5 + 0.3 * math.cos(angle), 0.5 + 0.3 * math.sin(angle))
+
+  k = 0.7 / math.sqrt(max(len(uids), 1))
+  for iteration in range(meshLayoutIterations):
+    temperature  = 0.1 * (1 - iteration / meshLayoutIterations)
+    displacement = {uid: [0.0, 0.0] for uid in uids}
+    for uid1, uid2 in combinations(uids, 2):
+      dx, dy   = positions[uid1][0] - positions[uid2][0], positions[uid1][1] - positions[uid2][1]
+      distance = max(math.hypot(dx, dy), 1e-3)
+      force    = k * k / distance / distance
+      displacement[uid1][0] += dx * force
+      displacement[uid1][1] += dy * force
+      displacement[uid2][0] -= dx * force
+      displacement[uid2][1] -= dy * force
+    for uid1, uid2 in edges:
+      dx, dy   = positions[uid1][0] - positions[uid2][0], positions[uid1][1] - positions[uid2][1]
+      force    = math.hypot(dx, dy) / k
+      displacement[uid1][0] -= dx * force
+      displacement[uid1][1] -= dy * force
+      displacement[uid2][0] += dx * force
+      displacement[uid2][1] += dy * force
+    for uid in uids:
+      dx, dy = displacement[uid]
+      length = max(math.hypot(dx, dy), 1e-9)
+      step   = min(length, temperature * (0.02 if uid in known else 1.0)) / length
+      x, y   = positions[uid]
+      positions[uid] = (min(max(x + dx * step, 0.0), 1.0), min(max(y + dy * step, 0.0), 1.0))
+  return MeshLayout(version, topology, positions)
+
+def meshScene(luaJson, positions, width, height):
+  # links: (x1, y1, x2, y2, stroke width, connected, rates label, label
+  # line), the labels of parallel links are stacked
+  # nodes: (x, y, radius, name, online, master), in pixels
+  margin = 60
+  def pixels(uid):
+    x, y = positions[uid]
+    return margin + x * (width - 2 * margin), margin + y * (height - 2 * margin)
+
+  nodes = meshNodes(luaJson)
+  links = dict()
+  for node in nodes:
+    for link in nodeLinks(node):
+      ends = (str(link.get('node_1_uid')), str(link.get('node_2_uid')))
+      if ends[0] != ends[1] and ends[0] in positions and ends[1] in positions:
+        links.setdefault(link['uid'], (ends, link))
+
+  linkLines = []
+  parallels = dict()
+  for ends, link in links.values():
+    connected = link.get('state') == 'CONNECTED'
+    # kbit/s, up to 1 + 4 pixels for multi gigabit links
+    strokeWidth = 1 + 4 * min(math.log10(1 + linkRate(link) / 1000) / 3.4, 1)
+    label = '%.0f/%.0f Mbit/s' % (numeric(link.get('cur_data_rate_rx')) / 1000,
+                                  numeric(link.get('cur_data_rate_tx')) / 1000) if connected else ''
+    labelLine = parallels.get(frozenset(ends), 0)
+    if label:
+      parallels[frozenset(ends)] = labelLine + 1
+    linkLines.append(pixels(ends[0]) + pixels(ends[1]) + (strokeWidth, connected, label, labelLine))
+
+  nodeCircles = []
+  for node in nodes:
+    if str(node['uid']) in positions:
+      master = node.get('mesh_role') == 'master'
+      online = any(link.get('state') == 'CONNECTED' for link in nodeLinks(node))
+      name   = str(node.get('device_name') or node.get('name') or node['uid'])
+      nodeCircles.append(pixels(str(node['uid'])) + (11 if master else 8, name, online, master))
+  return linkLines, nodeCircles
+
+def renderMeshSvg(version, scene, width, height):
+  linkLines, nodeCircles = scene
+  svg = ElementTree.Element('svg', {'xmlns': 'http://www.w3.org/2000/svg', 'width': str(width), 'height': str(height),
+                                    'viewBox': '0 0 %d %d' % (width, height),
+                                    'font-family': 'sans-serif', 'font-size': '12'})
+  ElementTree.SubElement(svg, 'title').text = 'Mesh version %d' % version
+  ElementTree.SubElement(svg, 'rect', {'width': '100%', 'height': '100%', 'fill': '#fff'})
+  for x1, y1, x2, y2, strokeWidth, connected, label, labelLine in linkLines:
+    line = ElementTree.SubElement(svg, 'line', {'x1': '%.1f' % x1, 'y1': '%.1f' % y1, 'x2': '%.1f' % x2, 'y2': '%.1f' % y2,
+                                                'stroke': '#000' if connected else '#a0a0a0',
+                                                'stroke-width': '%.1f' % strokeWidth})
+    if not connected:
+      line.set('stroke-dasharray', '4 4')
+    if label:
+      ElementTree.SubElement(svg, 'text', {'x': '%.1f' % ((x1 + x2) / 2), 'y': '%.1f' % ((y1 + y2) / 2 - 4 - 12 * labelLine),
+                                           'text-anchor': 'middle', 'font-size': '10', 'fill': '#404040',
+                                           'stroke': '#fff', 'stroke-width': '3', 'paint-order': 'stroke'}).text = label
+  for x, y, radius, name, online, master in nodeCircles:
+    ElementTree.SubElement(svg, 'circle', {'cx': '%.1f' % x, 'cy': '%.1f' % y, 'r': str(radius),
+                                           'fill': '#ddd' if master else '#fff',
+                                           'stroke': '#000' if online else '#a0a0a0', 'stroke-width': '2'})
+    ElementTree.SubElement(svg, 'text', {'x': '%.1f' % x, 'y': '%.1f' % (y + radius + 14), 'text-anchor': 'middle',
+                                         'fill': '#000' if online else '#a0a0a0',
+                                         'stroke': '#fff', 'stroke-width': '3', 'paint-order': 'stroke'}).text = name
+  return ElementTree.tostring(svg, encoding = 'utf-8')
+
+def renderMeshPng(version, scene, width, height):
+  # grayscale, for e-ink displays
+  linkLines, nodeCircles = scene
+  image = Image.new('L', (width, height), 255)
+  draw  = ImageDraw.Draw(image)
+  font  = ImageFont.load_default()
+  def centeredText(x, y, text, fill, background = None):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font = font)
+    x, y = x - (right - left) / 2, y - (bottom - top) / 2
+    if background is not None:
+      draw.rectangle([x + left - 1, y + top - 1, x + right + 1, y + bottom + 1], fill = background)
+    draw.text((x, y), text, fill = fill, font = font)
+
+  for x1, y1, x2, y2, strokeWidth, connected, label, labelLine in linkLines:
+    draw.line([(x1, y1), (x2, y2)], fill = 0 if connected else 160, width = round(strokeWidth))
+  for x1, y1, x2, y2, strokeWidth, connected, label, labelLine in linkLines:
+    if label:
+      centeredText((x1 + x2) / 2, (y1 + y2) / 2 - 8 - 12 * labelLine, label, 64, 255)
+  for x, y, radius, name, online, master in nodeCircles:
+    draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill = 221 if master else 255,
+                 outline = 0 if online else 160, width = 2)
+    centeredText(x, y + radius + 10, name, 0 if online else 160, 255)
+  output = io.BytesIO()
+  image.save(output, 'PNG', optimize = True)
+  return output.getvalue()
+
+async def renderMeshImage(box, kind, width, height, snapshot):
+  # lays out the mesh of the snapshot, starting from the last layout
+  loop = asyncio.get_running_loop()
+  layout = box.meshLayout
+  if layout.version != snapshot.version:
+    layout = await loop.run_in_executor(None, layoutMesh, layout, snapshot.version, snapshot.json)
+    if layout.version > box.meshLayout.version:
+      box.meshLayout = layout
+
+  render = renderMeshSvg if kind == 'svg' else renderMeshPng
+  body   = await loop.run_in_executor(
+      None, lambda: render(snapshot.version, meshScene(snapshot.json, layout.positions, width, height), width, height))
+  encodings = compressBody(body, snapshotBrotliQuality, snapshotGzipLevel) if kind == 'svg' else None
+  image = MeshImage(snapshot.version, body, encodings, contentTag(body))
+
+  current = box.meshImages.get((kind, width, height))
+  if current is None or current.version <= image.version:
+    box.meshImages[(kind, width, height)] = image
+    box.meshImages.move_to_end((kind, width, height))
+    if len(box.meshImages) > meshImagesLimit:
+      box.meshImages.popitem(last = False)
+  return image
+
+async def handleMeshImage(box, kind, request):
+  # the current mesh, rendered once per snapshot version, format and size
+  # (?width=<pixels>&height=<pixels>)
+  noteDemand(box)
+  snapshot = box.luaSnapshot
+  if snapshot.json is None:
+    raise web.HTTPServiceUnavailable()
+  try:
+    width  = int(request.query.get('width', meshImageSize[0]))
+    height = int(request.query.get('height', meshImageSize[1]))
+  except ValueError:
+    raise web.HTTPBadRequest(text = 'invalid image size')
+  # any other size would be a rendering of its own
+  if (width, height) not in meshImageSizes:
+    raise web.HTTPBadRequest(text = 'image size not one of ' + ', '.join('%dx%d' % size for size in meshImageSizes))
+
+  image = box.meshImages.get((kind, width, height))
+  if image is None or image.version != snapshot.version:
+    image = await singleFlight(pendingRenders, (box.name, kind, width, height, snapshot.version),
+                               lambda: renderMeshImage(box, kind, width, height, snapshot))
+  return encodedResponse(request, image.encodings,
+                         lambda encoding: image.body if encoding is None else image.encodings[encoding],
+                         image.etag, 'image/svg+xml' if kind == 'svg' else 'image/png', 'no-cache')
+
+async def handleLuaPush(box, request):
+  # server-sent events: one event per mesh change, each carrying the full
+  # /data.lua snapshot. The event frame is built once per snapshot.
+  # With ?patch=1, only the first event carries the snapshot, later ones
+  # are 'patch' events with the /data.diff answer since the last event.
+  patchMode = request.query.get('patch') == '1'
+  response = web.StreamResponse(headers = {'Content-Type':  'text/event-stream',
+                                           'Cache-Control': 'no-cache'})
+  await response.prepare(request)
+
+  wakeup = asyncio.Event()
+  noteDemand(box)
+  box.luaSubscribers.add(wakeup)
+  try:
+    lastVersion = request.headers.get('Last-Event-ID')
+    while not pushClosing:
+      wakeup.clear()
+      snapshot = box.luaSnapshot
+      if snapshot.event is not None and str(snapshot.version) != lastVersion:
+        since = parseVersion(lastVersion)
+        if patchMode and since is not None:
+          await response.write(b'event: patch\nid: ' + str(snapshot.version).encode()
+                               + b'\n' + eventData(luaChangesSince(snapshot, since)))
+        else:
+          await response.write(snapshot.event)
+        lastVersion = str(snapshot.version)
+
+      try:
+        await asyncio.wait_for(wakeup.wait(), pushKeepAlive)
+      except asyncio.TimeoutError:
+        await response.write(b': keep-alive\n\n')
+  finally:
+    box.luaSubscribers.discard(wakeup)
+
+  return response
+
+async def pushContext(app):
+  global pushClosing
+  pushClosing = False
+
+  yield
+
+async def closePushChannels(app):
+  # let open push channels end, so the shutdown does not wait for them
+  global pushClosing
+  pushClosing = True
+  for box in fritzBoxes:
+    wakeLuaSubscribers(box)
 
 async def prepareLuaResponse(request, response):
   # prevent browser cache of dynamic data
-  if (request.url.path == '/data.lua'):
+  if (request.url.path.endswith('/data.lua')):
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['Expires']       = '-1'
     response.headers['Pragma']        = 'no-cache'
@@ -165,158 +1823,1264 @@ async def prepareLuaResponse(request, response):
 
 # Fritzbox login using PBKDF2 as described here:
 # https://avm.de/fileadmin/user_upload/Global/Service/Schnittstellen/AVM_Technical_Note_-_Session_ID_deutsch_2021-05-03.pdf
-def updateLogin():
-  global currentSid
-  print('updateLogin()', datetime.now(), file=sys.stderr)
+def challengeResponse(box, challenge):
+  _, iterations_1, salt_1, iterations_2, salt_2 = challenge.split('$')
+
+  # the static hash only depends on the password and the first salt, which
+  # the box keeps across logins
+  if box.staticHash is None or box.staticHash[0] != (salt_1, iterations_1):
+    box.staticHash = ((salt_1, iterations_1), hashlib.pbkdf2_hmac(
+        "sha256",
+        box.password.encode(),
+        bytes.fromhex(salt_1),
+        int(iterations_1)
+    ))
+  static_hash = box.staticHash[1]
+
+  dynamic_hash = hashlib.pbkdf2_hmac(
+      "sha256",
+      static_hash,
+      bytes.fromhex(salt_2),
+      int(iterations_2)
+  )
+  return f"{salt_2}${dynamic_hash.hex()}"
+
+async def updateLogin(box):
+  print('updateLogin()', box.host, datetime.now(), file=sys.stderr)
   
-  response = requests.get('http://' + fritzboxHost + '/login_sid.lua?version=2&sid=' + currentSid)
-  if response.status_code == requests.codes.ok:
-    root = ElementTree.fromstring(response.content)
-    currentSid = root.find("SID").text
-
-    if currentSid != invalidSid:
-      print('old SID is still valid:', currentSid, file=sys.stderr)
-      return currentSid
+  async with upstreamSession.get('http://' + box.host + '/login_sid.lua?version=2&sid=' + box.currentSid) as response:
+    status, content = response.status, await response.read()
+  if status == 200:
+    root = ElementTree.fromstring(content)
+    box.currentSid = root.find("SID").text
+
+    if box.currentSid != invalidSid:
+      print('old SID is still valid:', box.currentSid, file=sys.stderr)
+      box.sidUsed = time.monotonic()
+      return box.currentSid
     else:
-      challenge = root.find("Challenge").text
-      _, iterations_1, salt_1, iterations_2, salt_2 = challenge.split('$')
-
-      static_hash = hashlib.pbkdf2_hmac(
-          "sha256",
-          fritzboxPassword.encode(),
-          bytes.fromhex(salt_1),
-          int(iterations_1)
-      )
-      dynamic_hash = hashlib.pbkdf2_hmac(
-          "sha256",
-          static_hash,
-          bytes.fromhex(salt_2),
-          int(iterations_2)
-      )
-      challenge_hash = f"{salt_2}${dynamic_hash.hex()}"
-
-      with requests.post(
-          'http://' + fritzboxHost + '/login_sid.lua?version=2',
-          data={'username': fritzboxUsername, 'response': challenge_hash},
-          headers={"Content-Type": "application/x-www-form-urlencoded"}
+      # PBKDF2 keeps a CPU busy for a while on small boards
+      challenge_hash = await asyncio.get_running_loop().run_in_executor(
+          None, challengeResponse, box, root.find("Challenge").text)
+
+      async with upstreamSession.post(
+          'http://' + box.host + '/login_sid.lua?version=2',
+          data={'username': box.username, 'response': challenge_hash}
       ) as sidResponse:
-        root = ElementTree.fromstring(sidResponse.text)
-        currentSid = root.find("SID").text
-        print('created new sid:', currentSid, file=sys.stderr)
-        return currentSid
+        root = ElementTree.fromstring(await sidResponse.read())
+      box.currentSid = root.find("SID").text
+      print('created new sid:', box.currentSid, file=sys.stderr)
+      if box.currentSid != invalidSid:
+        box.sidUsed = time.monotonic()
+        wakeFirmwareCheck(box)
+      return box.currentSid
   else:
-    currentSid = invalidSid
+    box.currentSid = invalidSid
     print('failed to update sid, setting to invalid.', file=sys.stderr)
-    return currentSid
-
-
-def updateLuaData():
-  global currentSid
-  global luaData, dataLock
-  with requests.post(
-      'http://' + fritzboxHost + '/data.lua',
-      data={'xhr': '1', 'sid': currentSid, 'lang': 'de', 'page': 'homeNet',
-            'xhrId': 'refresh', 'updating': '', 'fwcheckstarted': '',
-            'useajax': '1', 'no_sidrenew': ''},
-      headers={"Content-Type": "application/x-www-form-urlencoded"}
-  ) as luaResponse:
+    return box.currentSid
+
+async def countedLogin(box):
+  box.logins += 1
+  sid = invalidSid
+  try:
+    sid = await updateLogin(box)
+    return sid
+  finally:
+    if sid == invalidSid:
+      box.loginFailures += 1
+
+async def login(box):
+  # concurrent logins to a box (poller, keep-alive, startup) share one
+  try:
+    return await singleFlight(pendingLogins, box.name, lambda: countedLogin(box))
+  except (aiohttp.ClientError, asyncio.TimeoutError, ElementTree.ParseError, AttributeError, ValueError) as e:
+    print('login to', box.host, 'failed:', repr(e), file=sys.stderr)
+    return invalidSid
+
+async def keepSidAlive(box):
+  # the box drops a SID unused for 20 minutes. Renew it before, so no poll
+  # fails on an expired SID, even while polling is slow or paused.
+  while True:
+    await asyncio.sleep(max(box.sidUsed + sidRenewAfter - time.monotonic(), sidRetryInterval))
+    if time.monotonic() - box.sidUsed >= sidRenewAfter:
+      await login(box)
+
+
+def jsonPointer(path, key):
+  return path + '/' + str(key).replace('~', '~0').replace('/', '~1')
+
+def listUids(items):
+  # uids of a list of homeNet objects (nodes, interfaces, links), None for
+  # other lists
+  if not all(isinstance(item, dict) and 'uid' in item for item in items):
+    return None
+  uids = [item['uid'] for item in items]
+  return uids if len(set(uids)) == len(uids) else None
+
+def diffJsonList(old, new, path, patch):
+  oldUids, newUids = listUids(old), listUids(new)
+  if oldUids is None or newUids is None:
+    # positional lists: diff the common prefix, then add / remove the tail
+    for index in range(min(len(old), len(new))):
+      diffJson(old[index], new[index], jsonPointer(path, index), patch)
+    for index in range(len(old) - 1, len(new) - 1, -1):
+      patch.append({'op': 'remove', 'path': jsonPointer(path, index)})
+    for index in range(len(old), len(new)):
+      patch.append({'op': 'add', 'path': jsonPointer(path, index), 'value': new[index]})
+    return
+
+  oldSet, newSet = set(oldUids), set(newUids)
+  if [uid for uid in oldUids if uid in newSet] != [uid for uid in newUids if uid in oldSet]:
+    # reordered objects, not worth an exact move sequence
+    patch.append({'op': 'replace', 'path': path, 'value': new})
+    return
+
+  # remove vanished objects back to front, insert new ones front to back,
+  # afterwards the list has its new order and the kept objects can be diffed
+  for index in range(len(old) - 1, -1, -1):
+    if oldUids[index] not in newSet:
+      patch.append({'op': 'remove', 'path': jsonPointer(path, index)})
+  for index, uid in enumerate(newUids):
+    if uid not in oldSet:
+      patch.append({'op': 'add', 'path': jsonPointer(path, index), 'value': new[index]})
+  oldByUid = dict(zip(oldUids, old))
+  for index, uid in enumerate(newUids):
+    if uid in oldSet:
+      diffJson(oldByUid[uid], new[index], jsonPointer(path, index), patch)
+
+def diffJson(old, new, path = '', patch = None):
+  # RFC 6902 JSON patch transforming old into new. Lists of homeNet objects
+  # are matched by their uid, so a changed link yields a patch of that link.
+  if patch is None:
+    patch = []
+
+  if type(old) != type(new):
+    patch.append({'op': 'replace', 'path': path, 'value': new})
+  elif isinstance(new, dict):
+    for key in old:
+      if key not in new:
+        patch.append({'op': 'remove', 'path': jsonPointer(path, key)})
+    for key, value in new.items():
+      if key not in old:
+        patch.append({'op': 'add', 'path': jsonPointer(path, key), 'value': value})
+      else:
+        diffJson(old[key], value, jsonPointer(path, key), patch)
+  elif isinstance(new, list):
+    diffJsonList(old, new, path, patch)
+  elif old != new:
+    patch.append({'op': 'replace', 'path': path, 'value': new})
+  return patch
+
+def meshNodes(luaJson):
+  # the homeNet nodes of a snapshot: data.nodes[], each with its links in
+  # node_interfaces[].node_links[]
+  data  = luaJson.get('data') if isinstance(luaJson, dict) else None
+  nodes = data.get('nodes') if isinstance(data, dict) else None
+  if not isinstance(nodes, list):
+    return []
+  return [node for node in nodes if isinstance(node, dict) and 'uid' in node]
+
+def nodeLinks(node):
+  for interface in node.get('node_interfaces') or []:
+    if isinstance(interface, dict):
+      for link in interface.get('node_links') or []:
+        if isinstance(link, dict) and 'uid' in link:
+          yield link
+
+def numeric(value):
+  try:
+    return float(value or 0)
+  except (TypeError, ValueError):
+    return 0.0
+
+def linkRate(link):
+  # current data rate of the faster direction, kbit/s
+  return max(numeric(link.get('cur_data_rate_rx')), numeric(link.get('cur_data_rate_tx')))
+
+def parseJson(data):
+  return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def compactJson(value):
+  if orjson is not None:
+    return orjson.dumps(value)
+  return json.dumps(value, separators = (',', ':')).encode('utf-8')
+
+def apiBody(version, key, value):
+  return compactJson({'version': version, key: value})
+
+def buildMeshModel(version, luaJson):
+  nodes = meshNodes(luaJson)
+  names = {node['uid']: node.get('device_name') or node.get('name') for node in nodes}
+
+  summaries  = []
+  nodeBodies = dict()
+  links      = dict()
+  for node in nodes:
+    uid = node['uid']
+    summaries.append({'uid':       uid,
+                      'name':      names[uid],
+                      'mac':       node.get('device_mac_address'),
+                      'model':     node.get('device_model'),
+                      'mesh_role': node.get('mesh_role'),
+                      'is_meshed': node.get('is_meshed')})
+    nodeBodies[uid] = apiBody(version, 'node', node)
+    # both ends of a link list it
+    for link in nodeLinks(node):
+      links.setdefault(link['uid'], link)
+
+  # uids take precedence over MAC addresses, those over names
+  nodeKeys = dict()
+  for node in nodes:
+    if isinstance(names[node['uid']], str):
+      nodeKeys[names[node['uid']]] = node['uid']
+  for node in nodes:
+    if isinstance(node.get('device_mac_address'), str):
+      nodeKeys[node['device_mac_address'].upper()] = node['uid']
+  for node in nodes:
+    nodeKeys[str(node['uid'])] = node['uid']
+
+  # history: the current rates of each link, presence of each node (any
+  # connected link)
+  samples = []
+  for node in nodes:
+    online = any(link.get('state') == 'CONNECTED' for link in nodeLinks(node))
+    samples.append(('node/' + str(node['uid']) + '/online', 1.0 if online else 0.0))
+  for uid, link in links.items():
+    samples.append(('link/' + str(uid) + '/rx', numeric(link.get('cur_data_rate_rx'))))
+    samples.append(('link/' + str(uid) + '/tx', numeric(link.get('cur_data_rate_tx'))))
+
+  linkItems = sorted(((-linkRate(link), compactJson(dict(link, node_1_name = names.get(link.get('node_1_uid')),
+                                                                node_2_name = names.get(link.get('node_2_uid')))))
+                      for link in links.values()), key = lambda item: item[0])
+  return MeshModel(version, apiBody(version, 'nodes', summaries), nodeBodies, nodeKeys,
+                   [rate for rate, _ in linkItems], [link for _, link in linkItems], dict(), tuple(samples),
+                   meshEventState(nodes, names, links))
+
+def meshEventState(nodes, names, links):
+  eventNodes = {node['uid']: (names[node['uid']], node.get('device_mac_address'),
+                              any(link.get('state') == 'CONNECTED' for link in nodeLinks(node)))
+                for node in nodes}
+  interfaces = {interface.get('uid'): interface.get('name')
+                for node in nodes for interface in node.get('node_interfaces') or [] if isinstance(interface, dict)}
+
+  # the uplink of a node: its fastest connected link to a node one hop
+  # closer to the master
+  uplinks = dict()
+  level   = {node['uid'] for node in nodes if node.get('mesh_role') == 'master'}
+  seen    = set(level)
+  while level:
+    candidates = dict()
+    for link in links.values():
+      if link.get('state') != 'CONNECTED':
+        continue
+      for parent, child, interface in ((link.get('node_1_uid'), link.get('node_2_uid'), link.get('node_interface_2_uid')),
+                                       (link.get('node_2_uid'), link.get('node_1_uid'), link.get('node_interface_1_uid'))):
+        if parent in level and child in eventNodes and child not in seen:
+          candidate = (linkRate(link), str(parent), parent, interfaces.get(interface))
+          if child not in candidates or candidate[:2] > candidates[child][:2]:
+            candidates[child] = candidate
+    for child, (_, _, parent, interface) in candidates.items():
+      uplinks[child] = (parent, interface)
+    level = set(candidates)
+    seen |= level
+
+  eventLinks = {uid: (linkRate(link), link.get('node_1_uid'), link.get('node_2_uid')) for uid, link in links.items()}
+  return MeshEventState(eventNodes, uplinks, eventLinks)
+
+def queryLinks(model, minRate):
+  body = model.linkQueries.get(minRate)
+  if body is None:
+    count = bisect_right(model.linkRates, -minRate)
+    body = (b'{"version":' + str(model.version).encode() + b',"links":['
+            + b','.join(model.links[:count]) + b']}')
+    if len(model.linkQueries) >= linkQueriesLimit:
+      model.linkQueries.clear()
+    model.linkQueries[minRate] = body
+  return body
+
+def eventData(body):
+  # the body as it came from the box may span lines, each needs its prefix
+  return b''.join(b'data: ' + line + b'\n' for line in body.splitlines()) + b'\n'
+
+def createLuaSnapshot(previous, luaJson, newLuaData, source = None):
+  version = previous.version + 1
+
+  patches = ()
+  if previous.json is not None:
+    patch = b','.join(compactJson(op) for op in diffJson(previous.json, luaJson))
+    patches = (previous.patches + ((version, patch),))[-luaPatchHistory:]
+
+  # compress once per snapshot instead of once per polling client
+  return LuaSnapshot(newLuaData, luaJson, version, contentTag(newLuaData),
+                     compressBody(newLuaData, snapshotBrotliQuality, snapshotGzipLevel),
+                     b'id: ' + str(version).encode() + b'\n' + eventData(newLuaData),
+                     patches, buildMeshModel(version, luaJson), source)
+
+luaSidPattern = re.compile(rb'"sid"\s*:\s*"([^"\\]*)"')
+
+def processLuaData(previous, bootstrapSid, luaBody):
+  # the snapshot following previous, previous if the mesh did not change,
+  # None if the SID was not accepted. An unchanged body is recognized by
+  # its hash without the SID, which differs per login, before parsing it.
+  # The bootstrap SID is spliced into the body as is, unless more than one
+  # "sid" leaves it open which one is the SID of the answer.
+  match = luaSidPattern.search(luaBody)
+  if match is None:
+    return None
+  unique = luaSidPattern.search(luaBody, match.end()) is None
+  if unique and match.group(1) == invalidSid.encode():
+    return None
+  start, end = match.span(1) if unique else (len(luaBody), len(luaBody))
+
+  body   = memoryview(luaBody)
+  source = hashlib.blake2b(bootstrapSid.encode())
+  source.update(body[:start])
+  source.update(body[end:])
+  source = source.digest()
+  if source == previous.source:
+    return previous
+
+  try:
+    luaJson = parseJson(luaBody)
+    sid     = luaJson['sid']
+  except (ValueError, KeyError, TypeError):
+    return None
+  if sid == invalidSid:
+    return None
+  luaJson['sid'] = bootstrapSid
+  if unique and match.group(1) == str(sid).encode():
+    newLuaData = luaBody[:start] + bootstrapSid.encode() + luaBody[end:]
+  else:
+    newLuaData = compactJson(luaJson)
+  if newLuaData == previous.data:
+    return previous._replace(source = source)
+  return createLuaSnapshot(previous, luaJson, newLuaData, source)
+
+def openHistory(box):
+  # the main box has no name, '@' keeps the directories of boxes apart
+  history = History(os.path.join(historyDirectory or os.path.join(storeDirectory, 'history'), '@' + box.name))
+  for tierName, _, _, _ in historyTiers:
+    os.makedirs(os.path.join(history.directory, tierName), exist_ok = True)
+  try:
+    with open(os.path.join(history.directory, 'series.json'), 'rb') as f:
+      items = json.load(f)
+  except (IOError, ValueError):
+    items = dict()
+  # former versions had one column map for all tiers, of names only at first
+  if isinstance(items, list):
+    items = {tierName: items for tierName, _, _, _ in historyTiers}
+  for tierName, _, _, _ in historyTiers:
+    pairs = [[item, time.time()] if isinstance(item, str) else item for item in items.get(tierName, [])]
+    history.series[tierName]  = [name for name, _ in pairs]
+    history.seen[tierName]    = [seen for _, seen in pairs]
+    history.columns[tierName] = {name: column for column, (name, _) in enumerate(pairs) if name is not None}
+  return history
+
+def saveSeries(history):
+  # the times of the last samples are saved with each new segment, they
+  # only matter at the scale of the retention
+  writeFileAtomic(os.path.join(history.directory, 'series.json'),
+                  json.dumps({tierName: list(map(list, zip(history.series[tierName], history.seen[tierName])))
+                              for tierName in history.series}).encode('utf-8'))
+
+def closeHistory(history):
+  for _, fd in history.files.values():
+    os.close(fd)
+  history.files.clear()
+
+def historyColumn(history, tierName, name, timestamp):
+  # the column of name in the tier, None if it has none yet
+  column = history.columns[tierName].get(name)
+  if column is not None:
+    history.seen[tierName][column] = timestamp
+  return column
+
+def addHistoryColumn(history, tierName, name, timestamp):
+  series, seen = history.series[tierName], history.seen[tierName]
+  if None in series:
+    column = series.index(None)
+    series[column] = name
+    seen[column]   = timestamp
+  else:
+    column = len(series)
+    series.append(name)
+    seen.append(timestamp)
+  history.columns[tierName][name] = column
+  return column
+
+def retireSeries(history, tier, now):
+  # series without samples in any segment of the tier still kept, none of
+  # its segments written from now on holds data of their columns
+  tierName, _, span, retention = tier
+  series, seen = history.series[tierName], history.seen[tierName]
+  for column, name in enumerate(series):
+    if name is not None and seen[column] < now - retention - span:
+      series[column] = None
+      del history.columns[tierName][name]
+      history.slots.pop((tierName, column), None)
+  saveSeries(history)
+
+def segmentPath(history, tierName, segmentStart):
+  return os.path.join(history.directory, tierName, str(segmentStart) + '.f32')
+
+def pruneSegments(history, tier, now):
+  tierName, _, span, retention = tier
+  for name in os.listdir(os.path.join(history.directory, tierName)):
+    start = parseVersion(name.split('.')[0])
+    if start is not None and start + span < now - retention:
+      os.remove(os.path.join(history.directory, tierName, name))
+
+def segmentFile(history, tier, segmentStart, column):
+  # descriptor of the segment file, grown to hold column
+  tierName, step, span, _ = tier
+  current = history.files.get(tierName)
+  if current is None or current[0] != segmentStart:
+    if current is not None:
+      os.close(current[1])
+      pruneSegments(history, tier, segmentStart)
+      retireSeries(history, tier, segmentStart)
+    current = (segmentStart, os.open(segmentPath(history, tierName, segmentStart), os.O_RDWR | os.O_CREAT, 0o644))
+    history.files[tierName] = current
+
+  fd = current[1]
+  columnSize = span // step * 4
+  size = os.fstat(fd).st_size // columnSize * columnSize
+  if size < (column + 1) * columnSize:
+    os.pwrite(fd, array('f', [float('nan')]).tobytes() * (span // step) * (column + 1 - size // columnSize), size)
+  return fd
+
+def recordHistory(history, timestamp, samples):
+  # the columns of new series are saved before their first values
+  columns = dict()
+  for name, _ in samples:
+    for tierName, _, _, _ in historyTiers:
+      columns[(tierName, name)] = historyColumn(history, tierName, name, timestamp)
+  if None in columns.values():
+    for (tierName, name), column in columns.items():
+      if column is None:
+        columns[(tierName, name)] = addHistoryColumn(history, tierName, name, timestamp)
+    saveSeries(history)
+
+  for name, value in samples:
+    for tier in historyTiers:
+      tierName, step, span, _ = tier
+      column = columns[(tierName, name)]
+      slot = int(timestamp // step)
+      current, total, count = history.slots.get((tierName, column), (None, 0.0, 0))
+      if current != slot:
+        total, count = 0.0, 0
+      total, count = total + value, count + 1
+      history.slots[(tierName, column)] = (slot, total, count)
+
+      segmentStart = int(timestamp // span) * span
+      fd = segmentFile(history, tier, segmentStart, column)
+      os.pwrite(fd, array('f', [total / count]).tobytes(), column * (span // step) * 4 + (slot - segmentStart // step) * 4)
+
+def queryHistory(history, names, start, end):
+  # the finest tier holding the range with few enough points
+  now = time.time()
+  end = min(end, now)
+  for tier in historyTiers:
+    tierName, step, span, retention = tier
+    if start >= now - retention and (end - start) / step <= historyQueryPoints:
+      break
+  start = max(start, now - retention)
+  columnSize = span // step * 4
+
+  series = dict()
+  for name in names:
+    column = history.columns[tierName].get(name)
+    if column is None:
+      series[name] = None
+      continue
+    points = []
+    for segmentStart in range(int(start // span) * span, int(end) + 1, span):
+      try:
+        f = open(segmentPath(history, tierName, segmentStart), 'rb')
+      except FileNotFoundError:
+        continue
+      with f:
+        if os.fstat(f.fileno()).st_size < (column + 1) * columnSize:
+          continue
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as segment:
+          values = array('f', segment[column * columnSize:(column + 1) * columnSize])
+      for index, value in enumerate(values):
+        timestamp = segmentStart + index * step
+        if start <= timestamp <= end and value == value:
+          points.append([timestamp, round(value, 3)])
+    series[name] = points
+
+  return json.dumps({'from': start, 'to': end, 'step': step, 'series': series},
+                    separators = (',', ':')).encode('utf-8')
+
+def publishLuaSnapshot(box, snapshot):
+  # runs on the loop, the handlers always see a complete snapshot
+  box.luaSnapshot = snapshot
+  wakeLuaSubscribers(box)
+  try:
+    writeSharedSnapshot(box, snapshot)
+  except OSError as e:
+    print('could not save the snapshot of', box.host + ':', repr(e), file=sys.stderr)
+
+# each snapshot of a box is written to a file, which the workers memory
+# map and the next start serves until the box is polled. A JSON header
+# line lists the content codings and sizes of the bodies following it.
+def snapshotPath(box):
+  return os.path.join(snapshotDirectory or os.path.join(storeDirectory, 'snapshots'), '@' + box.name)
+
+def writeSharedSnapshot(box, snapshot):
+  bodies = [(None, snapshot.data)] + list(snapshot.encodings.items())
+  header = json.dumps({'version': snapshot.version, 'etag': snapshot.etag,
+                       'bodies':  [(encoding, len(body)) for encoding, body in bodies]})
+  os.makedirs(os.path.dirname(snapshotPath(box)), exist_ok = True)
+  writeFileAtomic(snapshotPath(box), header.encode('utf-8') + b'\n' + b''.join(body for _, body in bodies),
+                  sync = False)
+
+def replacedFile(filename):
+  # whether the file was replaced since the last call
+  try:
+    stat = os.stat(filename)
+  except FileNotFoundError:
+    return False
+  identity = (stat.st_ino, stat.st_mtime_ns)
+  if sharedFiles.get(filename) == identity:
+    return False
+  sharedFiles[filename] = identity
+  return True
+
+def readSharedSnapshot(box):
+  # the last snapshot the owner published, the empty one before
+  if not replacedFile(snapshotPath(box)):
+    return box.luaSnapshot
+  with open(snapshotPath(box), 'rb') as f:
+    mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+  end    = mapped.find(b'\n')
+  header = json.loads(mapped[:end])
+  view   = memoryview(mapped)
+  bodies = dict()
+  offset = end + 1
+  for encoding, size in header['bodies']:
+    bodies[encoding] = view[offset:offset + size]
+    offset += size
+  data = bodies.pop(None)
+  return LuaSnapshot(data, None, header['version'], header['etag'], bodies, None, (), None, None)
+
+def restoreLuaSnapshot(box):
+  # the last snapshot of the previous run, if any
+  try:
+    with open(snapshotPath(box), 'rb') as f:
+      header, _, bodies = f.read().partition(b'\n')
+    header = json.loads(header)
+    data   = bodies[:header['bodies'][0][1]]
+    box.luaSnapshot = createLuaSnapshot(emptyLuaSnapshot._replace(version = header['version'] - 1),
+                                        parseJson(data), data)
+  except FileNotFoundError:
+    pass
+  except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+    print('could not restore the snapshot of', box.host + ':', repr(e), file=sys.stderr)
+
+async def updateLuaData(box):
+  start = time.monotonic()
+  try:
+    async with upstreamSession.post(
+        'http://' + box.host + '/data.lua',
+        data={'xhr': '1', 'sid': box.currentSid, 'lang': 'de', 'page': 'homeNet',
+              'xhrId': 'refresh', 'updating': '', 'fwcheckstarted': '',
+              'useajax': '1', 'no_sidrenew': ''}
+    ) as luaResponse:
+      luaBody = await luaResponse.read()
+  except (aiohttp.ClientError, asyncio.TimeoutError):
+    return False
+  finally:
+    # moving average of the upstream latency, a timeout counts as well
+    latency = time.monotonic() - start
+    observe(box.upstreamSeconds['data.lua'], latency)
+    box.pollLatency = latency if box.polls == 0 else box.pollLatency + pollLatencyWeight * (latency - box.pollLatency)
+    box.polls += 1
+
+  # parsing, diffing and compressing a snapshot is CPU heavy
+  previous = box.luaSnapshot
+  snapshot = await asyncio.get_running_loop().run_in_executor(
+      None, processLuaData, previous, box.bootstrapSid, luaBody)
+  if snapshot is None:
+    return False
+  box.sidUsed = time.monotonic()
+  if snapshot.version != previous.version:
+    publishLuaSnapshot(box, snapshot)
+    if webhookTargets and previous.model is not None and snapshot.model is not None:
+      queueWebhookEvents(meshEvents(box, previous.model, snapshot.model))
+  else:
+    # same mesh, in a body the next poll is compared to
+    box.luaSnapshot = snapshot
+
+  # every poll is a sample, changed or not
+  if box.history is not None and snapshot.model is not None:
     try:
-      luaJson = json.loads(luaResponse.text)
-      if (luaJson['sid'] == invalidSid):
-        return False
-    except ValueError:
-      return False
+      await asyncio.get_running_loop().run_in_executor(
+          None, recordHistory, box.history, time.time(), snapshot.model.samples)
+    except OSError as e:
+      print('could not record the history of', box.host + ':', repr(e), file=sys.stderr)
+  return True
+
+
+# change events of the mesh, posted to the webhooks
+def eventNode(state, uid):
+  name, mac, _ = state.nodes.get(uid, (None, None, False))
+  return {'uid': uid, 'name': name, 'mac': mac}
+
+def meshEvents(box, previous, current):
+  # the events from the previous to the current MeshModel
+  old, new = previous.events, current.events
+  common   = {'box': box.name, 'time': round(time.time(), 3), 'version': current.version}
+  events   = []
+
+  for uid in list(old.nodes) + [uid for uid in new.nodes if uid not in old.nodes]:
+    wasOnline, isOnline = uid in old.nodes and old.nodes[uid][2], uid in new.nodes and new.nodes[uid][2]
+    if wasOnline != isOnline:
+      events.append(dict(common, type = 'node_online' if isOnline else 'node_offline',
+                         node = eventNode(new if uid in new.nodes else old, uid)))
+
+  for uid, uplink in new.uplinks.items():
+    if uid in old.uplinks and old.uplinks[uid] != uplink:
+      events.append(dict(common, type = 'uplink_change', node = eventNode(new, uid),
+                         previous = dict(eventNode(old, old.uplinks[uid][0]), interface = old.uplinks[uid][1]),
+                         current  = dict(eventNode(new, uplink[0]), interface = uplink[1])))
+
+  for uid, (rate, node1, node2) in new.links.items():
+    if uid not in old.links:
+      continue
+    oldRate = old.links[uid][0]
+    for threshold in linkRateThresholds:
+      if (oldRate < threshold) != (rate < threshold):
+        events.append(dict(common, type = 'link_rate', link = uid, threshold = threshold,
+                           direction = 'below' if rate < threshold else 'above', rate = rate, previous = oldRate,
+                           nodes = [eventNode(new, node1), eventNode(new, node2)]))
+  return events
+
+# a webhook receiver: its events wait in queue, undelivered batches in
+# spooled files below its directory, named by serial and event count
+class WebhookTarget:
+  def __init__(self, url, directory):
+    self.url       = url
+    self.directory = directory
+    self.queue     = deque()
+    self.spooled   = []
+    self.serial    = 0
+    self.wakeup    = None
+
+    # instrumentation, see renderMetrics
+    self.delivered = 0
+    self.failures  = 0
+    self.dropped   = 0
+
+def webhookDirectory(url):
+  # the URL may carry a secret, e.g. a Home Assistant webhook id
+  return os.path.join(spoolDirectory or os.path.join(storeDirectory, 'webhooks'),
+                      hashlib.sha256(url.encode('utf-8')).hexdigest()[:16])
+
+def webhookHost(target):
+  return urlparse(target.url).hostname or '?'
+
+def queueWebhookEvents(events):
+  # never blocks: a slow receiver only lets its queue grow
+  for target in webhookTargets:
+    target.queue.extend(events)
+    while len(target.queue) > webhookQueueLimit:
+      target.queue.popleft()
+      target.dropped += 1
+    if target.wakeup is not None:
+      target.wakeup.set()
+
+def openSpool(target):
+  os.makedirs(target.directory, exist_ok = True)
+  target.spooled = sorted(name for name in os.listdir(target.directory) if name.endswith('.json'))
+  target.serial  = int(target.spooled[-1].split('-')[0]) + 1 if target.spooled else 0
+
+def spoolBatch(target, batch):
+  # the file name of the batch and the function writing it
+  name = '%012d-%d.json' % (target.serial, len(batch))
+  target.serial += 1
+  return name, partial(writeFileAtomic, os.path.join(target.directory, name), compactJson(batch), False)
+
+def trimSpool(target):
+  while len(target.spooled) > webhookSpoolLimit:
+    name = target.spooled.pop(0)
+    target.dropped += int(name[:-len('.json')].split('-')[1])
+    try:
+      os.remove(os.path.join(target.directory, name))
+    except OSError:
+      pass
+
+async def spoolQueue(target):
+  # move the queued events to disk, until the receiver is back
+  while target.queue:
+    batch = [target.queue.popleft() for _ in range(min(len(target.queue), webhookBatchSize))]
+    name, write = spoolBatch(target, batch)
+    try:
+      await asyncio.get_running_loop().run_in_executor(None, write)
+    except OSError as e:
+      print('could not spool webhook events for', webhookHost(target) + ':', repr(e), file=sys.stderr)
+      target.queue.extendleft(reversed(batch))
+      return
+    except asyncio.CancelledError:
+      target.queue.extendleft(reversed(batch))
+      raise
+    target.spooled.append(name)
+  trimSpool(target)
+
+def readSpooledBatch(target, name):
+  with open(os.path.join(target.directory, name), 'rb') as f:
+    return parseJson(f.read())
+
+def removeSpooledBatch(target, name):
+  try:
+    os.remove(os.path.join(target.directory, name))
+  except FileNotFoundError:
+    pass
+
+async def postEvents(target, batch):
+  # whether the batch is done with: delivered, or rejected by the receiver
+  try:
+    async with webhookSession.post(target.url, data = compactJson({'events': batch}),
+                                   headers = {'Content-Type': 'application/json'}) as response:
+      await response.read()
+  except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+    print('could not post', len(batch), 'events to', webhookHost(target) + ':', repr(e), file=sys.stderr)
+    return False
+  if response.status < 300:
+    target.delivered += len(batch)
+    return True
+  if response.status < 500 and response.status not in (408, 429):
+    # retrying would not help
+    print(webhookHost(target), 'rejected', len(batch), 'events:', response.status, file=sys.stderr)
+    target.dropped += len(batch)
+    return True
+  print('could not post', len(batch), 'events to', webhookHost(target) + ':', response.status, file=sys.stderr)
+  return False
+
+async def deliverWebhooks(target):
+  # spooled batches go first, oldest first, then the queued events
+  loop  = asyncio.get_running_loop()
+  delay = webhookRetryInterval
+  while True:
+    if not target.spooled and not target.queue:
+      target.wakeup.clear()
+      await target.wakeup.wait()
+      await asyncio.sleep(webhookBatchDelay)
+
+    name = target.spooled[0] if target.spooled else None
+    if name is not None:
+      try:
+        batch = await loop.run_in_executor(None, readSpooledBatch, target, name)
+      except (OSError, ValueError) as e:
+        print('dropping spooled webhook events', name + ':', repr(e), file=sys.stderr)
+        target.spooled.pop(0)
+        await loop.run_in_executor(None, removeSpooledBatch, target, name)
+        continue
     else:
-      luaJson['sid'] = bootstrapSid
-      with dataLock:
-        luaData = json.dumps(luaJson).encode('utf-8')
-      return True
+      batch = [target.queue.popleft() for _ in range(min(len(target.queue), webhookBatchSize))]
+
+    try:
+      done = await postEvents(target, batch)
+    except asyncio.CancelledError:
+      if name is None:
+        target.queue.extendleft(reversed(batch))
+      raise
+    if done:
+      delay = webhookRetryInterval
+      if name is not None:
+        target.spooled.pop(0)
+        await loop.run_in_executor(None, removeSpooledBatch, target, name)
+      continue
+
+    target.failures += 1
+    if name is None:
+      target.queue.extendleft(reversed(batch))
+    await spoolQueue(target)
+    await asyncio.sleep(delay)
+    delay = min(2 * delay, webhookRetryLimit)
+
+async def webhooksContext(app):
+  global webhookSession
+  webhookSession = aiohttp.ClientSession(timeout = webhookTimeout)
+  for target in webhookTargets:
+    try:
+      openSpool(target)
+    except OSError as e:
+      print('could not open the webhook spool of', webhookHost(target) + ':', repr(e), file=sys.stderr)
+    target.wakeup = asyncio.Event()
+  senders = [asyncio.ensure_future(deliverWebhooks(target)) for target in webhookTargets]
+
+  yield
+
+  # undelivered events are kept for the next start
+  await stopTasks(senders)
+  for target in webhookTargets:
+    target.wakeup = None
+    while target.queue:
+      name, write = spoolBatch(target, [target.queue.popleft() for _ in range(min(len(target.queue), webhookBatchSize))])
+      try:
+        write()
+      except OSError as e:
+        print('could not spool webhook events for', webhookHost(target) + ':', repr(e), file=sys.stderr)
+        break
+  await webhookSession.close()
+
+
+def isWatched(box):
+  return bool(box.luaSubscribers) or time.monotonic() - box.pollDemand < pollIdleAfter
+
+def noteDemand(box):
+  # a client shows up for an idle box: poll right away
+  if not isWatched(box) and box.pollWakeup is not None:
+    box.pollWakeup.set()
+  box.pollDemand = time.monotonic()
+
+def schedulePoll(box):
+  if not isWatched(box):
+    return idlePollInterval
+  return max(activePollInterval, box.pollLatency / pollLoadShare)
+
+async def retryStartup(box, step):
+  # step(box) until it succeeds, with exponential backoff
+  delay = startupRetryInterval
+  while not await step(box):
+    box.startupRetries += 1
+    await asyncio.sleep(delay)
+    delay = min(2 * delay, startupRetryLimit)
+
+async def startBox(box):
+  # log in, fetch the main page and its assets, then poll the mesh once.
+  # Until then the cache and the snapshot of the previous run are served.
+  await retryStartup(box, warmUp)
+  box.startupState = 'polling'
+  wakeFirmwareCheck(box)
+  await retryStartup(box, updateLuaData)
+  box.startupState = 'ready'
+  print('started', box.host, file=sys.stderr)
+
+async def pollLuaData(box):
+  await startBox(box)
+  while True:
+    box.pollInterval = schedulePoll(box)
+    box.pollWakeup.clear()
+    try:
+      await asyncio.wait_for(box.pollWakeup.wait(), box.pollInterval)
+    except asyncio.TimeoutError:
+      pass
+
+    if not await updateLuaData(box):
+      box.pollFailures += 1
+      sid = await login(box)
+      if box.bootstrapSid == invalidSid and sid != invalidSid:
+        # the box was not reachable at startup
+        box.bootstrapSid = sid
+
+async def pollerContext(app):
+  # serve the mesh data of the previous run and start polling
+  for box in fritzBoxes:
+    box.history = openHistory(box)
+    restoreLuaSnapshot(box)
+    box.pollWakeup = asyncio.Event()
+  pollers = [asyncio.ensure_future(pollLuaData(box)) for box in fritzBoxes]
+  pollers += [asyncio.ensure_future(keepSidAlive(box)) for box in fritzBoxes]
+
+  yield
+
+  await stopTasks(pollers)
+  for box in fritzBoxes:
+    box.pollWakeup = None
+    closeHistory(box.history)
+    box.history = None
+
+
+# metrics of each box: (name, type, help, value of the box)
+boxMetrics = [
+  ('fritzmesh_ready',                 'gauge',   'Whether the box was logged in to and polled', lambda box: int(box.startupState == 'ready')),
+  ('fritzmesh_startup_retries_total', 'counter', 'Failed startup attempts',                   lambda box: box.startupRetries),
+  ('fritzmesh_poll_interval_seconds', 'gauge',   'Current mesh poll interval, 0 while paused', lambda box: box.pollInterval or 0),
+  ('fritzmesh_poll_latency_seconds',  'gauge',   'Moving average of the data.lua latency',    lambda box: box.pollLatency),
+  ('fritzmesh_poll_watched',          'gauge',   'Whether clients watch the mesh',            lambda box: int(isWatched(box))),
+  ('fritzmesh_push_channels',         'gauge',   'Open push channels',                        lambda box: len(box.luaSubscribers)),
+  ('fritzmesh_polls_total',           'counter', 'Mesh polls',                                lambda box: box.polls),
+  ('fritzmesh_poll_failures_total',   'counter', 'Failed mesh polls',                         lambda box: box.pollFailures),
+  ('fritzmesh_cache_hits_total',      'counter', 'Asset requests answered from the cache',    lambda box: box.cacheHits),
+  ('fritzmesh_cache_misses_total',    'counter', 'Asset requests fetched from the box',       lambda box: box.cacheMisses),
+  ('fritzmesh_logins_total',          'counter', 'Login attempts',                            lambda box: box.logins),
+  ('fritzmesh_login_failures_total',  'counter', 'Login attempts without a valid SID',        lambda box: box.loginFailures),
+  ('fritzmesh_negative_hits_total',   'counter', 'Requests answered with a cached failure',   lambda box: box.negativeHits),
+  ('fritzmesh_client_limited_total',  'counter', 'Misses rejected by the client limit',        lambda box: box.limitedClients),
+  ('fritzmesh_box_limited_total',     'counter', 'Misses rejected by the box limit',           lambda box: box.limitedFetches),
+  ('fritzmesh_mesh_version',          'gauge',   'Version of the current mesh snapshot',      lambda box: box.luaSnapshot.version),
+  ('fritzmesh_mesh_nodes',            'gauge',   'Nodes in the current mesh snapshot',
+   lambda box: len(box.luaSnapshot.model.nodeBodies) if box.luaSnapshot.model is not None else 0),
+  ('fritzmesh_mesh_links',            'gauge',   'Links in the current mesh snapshot',
+   lambda box: len(box.luaSnapshot.model.links) if box.luaSnapshot.model is not None else 0),
+]
+
+# metrics of each webhook receiver, labeled by its index in webhookUrls and
+# its host, not the URL, which may carry a secret
+webhookMetrics = [
+  ('fritzmesh_webhook_queued_events',    'gauge',   'Events waiting in memory',                  lambda target: len(target.queue)),
+  ('fritzmesh_webhook_spooled_batches',  'gauge',   'Undelivered batches spooled to disk',       lambda target: len(target.spooled)),
+  ('fritzmesh_webhook_delivered_total',  'counter', 'Delivered events',                          lambda target: target.delivered),
+  ('fritzmesh_webhook_failures_total',   'counter', 'Failed deliveries of a batch',              lambda target: target.failures),
+  ('fritzmesh_webhook_dropped_total',    'counter', 'Events dropped: queue or spool full, or rejected', lambda target: target.dropped),
+]
+
+def metricLabels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                        for name, value in labels) + '}'
 
+def metricHeader(lines, name, kind, description):
+  lines.append('# HELP ' + name + ' ' + description)
+  lines.append('# TYPE ' + name + ' ' + kind)
 
-def luaThreadMain():
+def histogramLines(lines, name, labels, histogram):
+  count = 0
+  for bound, bucketCount in zip(histogram.buckets + ('+Inf',), histogram.counts):
+    count += bucketCount
+    lines.append(name + '_bucket' + metricLabels(labels + (('le', bound),)) + ' ' + str(count))
+  lines.append(name + '_sum' + metricLabels(labels) + ' ' + repr(histogram.sum))
+  lines.append(name + '_count' + metricLabels(labels) + ' ' + str(count))
+
+def linkRateSamples(box):
+  # current rates of each link of the snapshot, labeled with its ends
+  nodes = meshNodes(box.luaSnapshot.json)
+  names = {node['uid']: node.get('device_name') or node.get('name') or node['uid'] for node in nodes}
+  links = dict()
+  for node in nodes:
+    for link in nodeLinks(node):
+      links.setdefault(link['uid'], link)
+  for uid, link in links.items():
+    labels = (('box', box.name), ('link', uid),
+              ('node_1', names.get(link.get('node_1_uid'), link.get('node_1_uid'))),
+              ('node_2', names.get(link.get('node_2_uid'), link.get('node_2_uid'))))
+    yield labels + (('direction', 'rx'),), numeric(link.get('cur_data_rate_rx'))
+    yield labels + (('direction', 'tx'),), numeric(link.get('cur_data_rate_tx'))
+
+def renderMetrics():
+  # Prometheus text format. The request paths only bump plain counters and
+  # histogram buckets, everything else is derived here, on scrape.
+  lines = []
+  for name, kind, description, value in boxMetrics:
+    metricHeader(lines, name, kind, description)
+    for box in fritzBoxes:
+      lines.append(name + metricLabels((('box', box.name),)) + ' ' + str(value(box)))
+
+  for name, kind, description, value in webhookMetrics if webhookTargets else []:
+    metricHeader(lines, name, kind, description)
+    for index, target in enumerate(webhookTargets):
+      lines.append(name + metricLabels((('target', index), ('host', webhookHost(target)))) + ' ' + str(value(target)))
+
+  metricHeader(lines, 'fritzmesh_upstream_seconds', 'histogram', 'Latency of requests to the box')
+  for box in fritzBoxes:
+    for request, histogram in box.upstreamSeconds.items():
+      histogramLines(lines, 'fritzmesh_upstream_seconds', (('box', box.name), ('request', request)), histogram)
+
+  metricHeader(lines, 'fritzmesh_bootstrap_seconds', 'histogram', 'Time spent sanitizing an asset')
+  histogramLines(lines, 'fritzmesh_bootstrap_seconds', (), bootstrapSeconds)
+
+  metricHeader(lines, 'fritzmesh_link_rate_kbits', 'gauge', 'Current data rate of a mesh link, kbit/s')
+  for box in fritzBoxes:
+    for labels, rate in linkRateSamples(box):
+      lines.append('fritzmesh_link_rate_kbits' + metricLabels(labels) + ' ' + repr(rate))
+  return ('\n'.join(lines) + '\n').encode('utf-8')
+
+async def handleMetrics(request):
+  return web.Response(
+      body = renderMetrics(),
+      headers = {'Content-Type':  'text/plain; version=0.0.4; charset=utf-8',
+                 'Cache-Control': 'no-cache'})
+
+async def handleReady(request):
+  # startup progress of each box, 503 until all of them are ready
+  boxes = {box.name: {'host':    box.host,
+                      'state':   box.startupState,
+                      'stale':   box.startupState != 'ready' and box.luaSnapshot.data is not None,
+                      'retries': box.startupRetries}
+           for box in fritzBoxes}
+  ready = all(box.startupState == 'ready' for box in fritzBoxes)
+  return web.json_response({'ready': ready, 'boxes': boxes}, status = 200 if ready else 503,
+                           headers = {'Cache-Control': 'no-cache'})
+
+
+def boxRoutes(box):
+  prefix = box.prefix
+  routes = [web.get(prefix + 'data.sse', partial(handleLuaPush, box)),
+            web.get(prefix + 'data.diff', partial(handleLuaDiffRequest, box)),
+            web.get(prefix + 'api/nodes', partial(handleApiNodes, box)),
+            web.get(prefix + 'api/nodes/{key}', partial(handleApiNode, box)),
+            web.get(prefix + 'api/links', partial(handleApiLinks, box)),
+            web.get(prefix + 'api/history', partial(handleApiHistory, box)),
+            web.get(prefix + 'mesh.svg', partial(handleMeshImage, box, 'svg')),
+            web.get(prefix + '{tail:.*}', partial(do_GET, box)),
+            web.post(prefix + 'data.lua', partial(handleLuaDataRequest, box))]
+  if Image is not None:
+    routes.insert(0, web.get(prefix + 'mesh.png', partial(handleMeshImage, box, 'png')))
+  if prefix != '/':
+    routes.append(web.get(prefix[:-1], partial(redirectToPrefix, box)))
+  return routes
+
+async def portsContext(app):
+  # boxes with a port of their own are served by an application each
+  runners = []
+  for port in sorted(set(box.port for box in fritzBoxes if box.port is not None)):
+    runner = web.AppRunner(createApp(port))
+    await runner.setup()
+    await web.TCPSite(runner, port = port).start()
+    runners.append(runner)
+
+  yield
+
+  for runner in runners:
+    await runner.cleanup()
+
+def createApp(port = None):
+  # the application of the main port (None) or of another port. Boxes with
+  # a prefix go first, the catch-all route of the main box comes last.
+  httpd = web.Application()
+  if port is None:
+    httpd.add_routes([web.get('/metrics', handleMetrics), web.get('/ready', handleReady)])
+  for box in sorted((box for box in fritzBoxes if box.port == port), key = lambda box: box.prefix == '/'):
+    httpd.add_routes(boxRoutes(box))
+  httpd.on_response_prepare.append(prepareLuaResponse)
+  if port is None:
+    httpd.cleanup_ctx.append(upstreamContext)
+    httpd.cleanup_ctx.append(pushContext)
+    httpd.cleanup_ctx.append(revalidationContext)
+    if webhookTargets:
+      httpd.cleanup_ctx.append(webhooksContext)
+    httpd.cleanup_ctx.append(pollerContext)
+    httpd.cleanup_ctx.append(portsContext)
+    if workerCount > 1:
+      httpd.cleanup_ctx.append(workersContext)
+    httpd.on_shutdown.append(closePushChannels)
+  return httpd
+
+
+# multi-worker mode, see workerCount. The owner serves the workers on a
+# unix socket in the store directory.
+def ownerSocketPath():
+  return os.path.join(storeDirectory, 'owner.sock')
+
+async def workersContext(app):
+  # the other workers serve the snapshots of the previous run as well until
+  # the boxes are polled
+  context = multiprocessing.get_context('spawn')
+  workers = [context.Process(target = runWorker, daemon = True,
+                             args = (storeDirectory, snapshotDirectory, mainPort,
+                                     [(box.name, box.port) for box in fritzBoxes]))
+             for _ in range(workerCount - 1)]
+  for worker in workers:
+    worker.start()
+
+  yield
+
+  for worker in workers:
+    worker.terminate()
+  await asyncio.get_running_loop().run_in_executor(None, lambda: [worker.join() for worker in workers])
+
+def runWorker(directory, snapshots, port, boxes):
+  global storeDirectory, snapshotDirectory, storeOwner
+  storeDirectory    = directory
+  snapshotDirectory = snapshots
+  storeOwner        = False
+  for name, boxPort in boxes:
+    fritzBoxes.append(FritzBox(name, None, None, None, boxPort))
+  try:
+    web.run_app(createWorkerApp(), port = port, reuse_port = True, print = None)
+  except KeyboardInterrupt:
+    pass
+
+def readSharedIndex():
+  # whether the owner saved a new store index, which is loaded then
+  if not replacedFile(indexPath()):
+    return False
+  try:
+    with open(indexPath(), 'rb') as f:
+      index = json.load(f)
+  except (IOError, ValueError):
+    return False
+  cachedData.clear()
+  restoreStoreIndex(index)
+  return True
+
+async def watchSharedIndex():
   while True:
-    time.sleep(5.0)
-    if not updateLuaData():
-      updateLogin()
+    readSharedIndex()
+    await asyncio.sleep(workerIndexInterval)
+
+hopByHopHeaders = ('connection', 'keep-alive', 'transfer-encoding', 'upgrade')
+
+async def forwardToOwner(request):
+  # answer with the response of the owner, forwarded as it arrives
+  stream = None
+  try:
+    async with ownerSession.request(
+        request.method, 'http://owner' + request.raw_path,
+        headers = [(name, value) for name, value in request.headers.items()
+                   if name.lower() not in hopByHopHeaders + ('host', 'content-length', 'x-fritzmesh-client')]
+                  + [('X-Fritzmesh-Client', request.remote)],
+        data = await request.read() if request.body_exists else None, allow_redirects = False) as response:
+      stream = web.StreamResponse(status = response.status, headers = [
+          (name, value) for name, value in response.headers.items() if name.lower() not in hopByHopHeaders])
+      await stream.prepare(request)
+      async for chunk in response.content.iter_any():
+        await stream.write(chunk)
+  except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+    if stream is None:
+      print('could not forward', request.raw_path, 'to the owner:', repr(e), file=sys.stderr)
+      raise web.HTTPBadGateway()
+  return stream
+
+async def handleWorkerGet(box, request):
+  # cached assets are served from the store, everything else by the owner
+  path = cachePath(box, request.url.path_qs[len(box.prefix) - 1:])
+  entry = cachedData.get((box.generation, path))
+  if entry is None and readSharedIndex():
+    entry = cachedData.get((box.generation, path))
+  if entry is not None:
+    try:
+      return await cachedResponse(box, request, path, entry)
+    except FileNotFoundError:
+      # evicted by the owner
+      pass
+  return await forwardToOwner(request)
+
+async def handleWorkerLuaData(box, request):
+  # box.pollDemand: when a request was last forwarded to the owner
+  if time.monotonic() - box.pollDemand >= workerDemandInterval:
+    box.pollDemand = time.monotonic()
+    return await forwardToOwner(request)
+  try:
+    box.luaSnapshot = readSharedSnapshot(box)
+  except (OSError, ValueError, KeyError) as e:
+    print('could not read the shared snapshot', snapshotPath(box) + ':', repr(e), file=sys.stderr)
+  if box.luaSnapshot.data is None:
+    return await forwardToOwner(request)
+  return luaDataResponse(request, box.luaSnapshot)
+
+async def workerContext(app):
+  global ownerSession
+  ownerSession = aiohttp.ClientSession(
+      connector       = aiohttp.UnixConnector(path = ownerSocketPath()),
+      timeout         = aiohttp.ClientTimeout(total = None, sock_connect = 5),
+      auto_decompress = False)
+  watcher = asyncio.ensure_future(watchSharedIndex())
+
+  yield
+
+  await stopTasks([watcher])
+  await ownerSession.close()
+
+def createWorkerApp():
+  httpd = web.Application()
+  for box in sorted((box for box in fritzBoxes if box.port is None), key = lambda box: box.prefix == '/'):
+    httpd.add_routes([web.post(box.prefix + 'data.lua', partial(handleWorkerLuaData, box)),
+                      web.get(box.prefix + '{tail:.*}', partial(handleWorkerGet, box))])
+  httpd.add_routes([web.route('*', '/{tail:.*}', forwardToOwner)])
+  httpd.on_response_prepare.append(prepareLuaResponse)
+  httpd.cleanup_ctx.append(workerContext)
+  return httpd
 
 
+def readBoxConfig(section, name, mainPort):
+  port = section.getint('fritzMeshPort')
+  return FritzBox(name, section['fritzboxHost'], section['fritzboxUsername'], section['fritzboxPassword'],
+                  port if name and port is not None and port != mainPort else None)
+
 def main():
-  global bootstrapSid
-  global cachedData
-  global fritzboxUsername, fritzboxPassword, fritzboxHost
+  global storeDirectory, manifestFilename, prefetchConcurrency, workerCount, mainPort
+  global spoolDirectory, historyDirectory, snapshotDirectory, webhookUrls, linkRateThresholds, trustedProxies
 
   # load config
   try:
     if '-hassio' in sys.argv[1:]:
       configFilename = '/data/options.json'
       fritzMeshPort    = 8099
-      cacheFilename = '/data/cache.pickle'
+      cacheDirectory = '/data/store'
+      cacheFilename  = '/data/cache.pickle'
+      manifestFilename = '/data/manifest.json'
+      spoolDirectory = '/data/webhooks'
+      historyDirectory = '/data/history'
+      snapshotDirectory = '/data/snapshots'
+      # the ingress requests of Home Assistant pass its core and the supervisor
+      trustedProxies = ('172.30.32.1', '172.30.32.2')
       with open(configFilename, 'r') as hassConfigFile:
         hassConfig = json.loads(hassConfigFile.read())
-        fritzboxUsername = hassConfig["Fritzbox username"]
-        fritzboxPassword = hassConfig["Fritzbox password"]
-        fritzboxHost     = hassConfig["fritzbox host"]
+        prefetchConcurrency = int(hassConfig.get("Prefetch concurrency", prefetchConcurrency))
+        workerCount = int(hassConfig.get("Workers", workerCount))
+        webhookUrls = list(hassConfig.get("Webhook URLs", webhookUrls))
+        linkRateThresholds = tuple(int(threshold) for threshold in hassConfig.get("Link rate thresholds", linkRateThresholds))
+        fritzBoxes.append(FritzBox('', hassConfig["fritzbox host"],
+                                   hassConfig["Fritzbox username"], hassConfig["Fritzbox password"]))
+        for boxConfig in hassConfig.get("Additional Fritzboxes", []):
+          fritzBoxes.append(FritzBox(boxConfig["name"], boxConfig["host"], boxConfig["username"], boxConfig["password"]))
     else:
       configFilename = '/etc/fritzmesh'
       fritzMeshPort  = 8765
+      cacheDirectory = '/var/cache/fritzmesh/store'
       cacheFilename  = '/var/cache/fritzmesh/cache.pickle'
+      manifestFilename = '/var/cache/fritzmesh/manifest.json'
+      spoolDirectory = '/var/cache/fritzmesh/webhooks'
+      historyDirectory = '/var/cache/fritzmesh/history'
+      snapshotDirectory = '/var/cache/fritzmesh/snapshots'
       with open(configFilename, 'r') as f:
+        # the top level settings configure the main box, each section an
+        # additional one, served below /<section name>/ or on its own port
         configString = "[DummyTop]\n" + f.read()
         config = configparser.ConfigParser()
         config.read_string(configString)
-        config = config['DummyTop']
-        fritzboxUsername = config['fritzboxUsername']
-        fritzboxPassword = config['fritzboxPassword']
-        fritzboxHost     = config['fritzboxHost']
-        fritzMeshPort    = config.getint('fritzMeshPort')
-  except (IOError, KeyError):
+        fritzMeshPort = config['DummyTop'].getint('fritzMeshPort')
+        prefetchConcurrency = config['DummyTop'].getint('prefetchConcurrency', prefetchConcurrency)
+        workerCount = config['DummyTop'].getint('fritzMeshWorkers', workerCount)
+        webhookUrls = config['DummyTop'].get('webhookUrls', '').split()
+        if 'linkRateThresholds' in config['DummyTop']:
+          linkRateThresholds = tuple(int(threshold) for threshold in config['DummyTop']['linkRateThresholds'].replace(',', ' ').split())
+        for name in config.sections():
+          if name != 'DummyTop':
+            fritzBoxes.append(readBoxConfig(config[name], name, fritzMeshPort))
+          elif 'fritzboxHost' in config[name] or len(config.sections()) == 1:
+            fritzBoxes.append(readBoxConfig(config[name], '', fritzMeshPort))
+  except (IOError, KeyError, ValueError):
     print("Could not read config file '" + configFilename + "'. Exiting.", file=sys.stderr)
     return
 
-  # load previously cached data
-  if not '-nocache' in sys.argv[1:]:
-    try:
-      with open(cacheFilename, 'rb') as f:
-        cachedData = pickle.load(f)
-        for key in cachedData:
-          if key.startswith('/?sid='):
-            query = dict(parse_qsl(urlparse(key).query))
-            bootstrapSid = query['sid']
-    except IOError:
-      pass
-
-  # get a valid login and sid from Fritzbox
-  mySid = updateLogin()
-  if (mySid == invalidSid):
-    print("Could not access Fritzbox. Exiting.", file=sys.stderr)
+  names = [box.name for box in fritzBoxes]
+  invalidNames = [name for name in names if not re.fullmatch(r'[\w.-]*', name) or names.count(name) > 1]
+  if invalidNames:
+    print("Invalid Fritzbox names in config file '" + configFilename + "':", ', '.join(invalidNames), file=sys.stderr)
     return
-    
-  if (bootstrapSid == invalidSid):
-    # we got a valid sid for the first time. 
-    bootstrapSid = mySid
 
-  # make sure main page is cached with bootstrap SID
-  getResponse('/')
-  
-  # fill initial mesh data and start polling
-  updateLuaData()
-  threading.Thread(target=luaThreadMain, daemon=True).start()
+  # open the asset store with the previously cached data. Without cache,
+  # use a temporary store, which is removed on exit. The asset manifest is
+  # kept either way.
+  if '-nocache' in sys.argv[1:]:
+    storeDirectory = tempfile.mkdtemp(prefix = 'fritzmesh')
+    openAssetStore()
+  else:
+    storeDirectory = cacheDirectory
+    openAssetStore(cacheFilename)
 
-  # start the webserver
-  httpd = web.Application()
-  httpd.add_routes([web.get('/{tail:.*}', do_GET),
-                    web.post('/data.lua', handleLuaDataRequest)])
-  httpd.on_response_prepare.append(prepareLuaResponse)
+  # like the manifest, the spool of undelivered webhook events, the
+  # history and the last snapshots are kept
+  webhookTargets.extend(WebhookTarget(url, webhookDirectory(url)) for url in webhookUrls)
 
+  # start the webserver, logging in to and polling each box. With several
+  # workers, the owner serves them on a unix socket as well.
+  mainPort = fritzMeshPort
   try:
-    web.run_app(httpd, port = fritzMeshPort)
+    web.run_app(createApp(), port = fritzMeshPort, reuse_port = workerCount > 1,
+                path = ownerSocketPath() if workerCount > 1 else None)
   except KeyboardInterrupt:
     pass
-    
-  # store the cache data
-  if not '-nocache' in sys.argv[1:]:
-    with open(cacheFilename, 'wb') as f:
-      pickle.dump(cachedData, f, pickle.HIGHEST_PROTOCOL)
+
+  # the asset store is written as it is filled, just clean up a temporary one
+  if '-nocache' in sys.argv[1:]:
+    shutil.rmtree(storeDirectory, ignore_errors = True)
 
 if __name__ == '__main__':
   main()